@@ -0,0 +1,282 @@
+"""Backfill Asana from the history of GitHub issues and pull requests.
+
+Issues (and pull requests, which GitHub lists as issues) are listed from
+each repository a page at a time, with the pages fetched concurrently, and
+sent through the same pipeline as webhook deliveries: published to SNS, 10
+messages to a request, or synced straight to Asana with ``--direct``.
+
+Progress is kept in a checkpoint file, so that an interrupted run picks up
+where it left off when run again; an issue is only sent again if it has
+been updated since. For example::
+
+    GITHUB_TOKEN=... python backfill.py --since 2019-10-01 --topic arn:aws:sns:...
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+import botocore.session
+import requests
+from requests.utils import parse_header_links
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'code'))
+
+from payload import compact  # noqa: E402
+from ratelimit import scheduler  # noqa: E402
+
+logger = logging.getLogger('asanabot')
+
+API = 'https://api.github.com'
+
+REPOS = ['MetPy', 'siphon', 'python-gallery', 'python-workshop']
+
+# Issues per page when listing; the most GitHub allows
+PER_PAGE = 100
+
+# SNS takes up to 10 messages, totalling 256 KiB, in a batch
+SNS_BATCH_SIZE = 10
+SNS_BATCH_BYTES = 256 * 1024
+
+# Messages to hand to sync_messages at a time with --direct
+DIRECT_BATCH_SIZE = 100
+
+
+class GitHub:
+    """Just enough of the GitHub REST API to list a repository's issues."""
+
+    def __init__(self, token=None):
+        self.session = scheduler.install(requests.Session(), 'github')
+        self.headers = {'Accept': 'application/vnd.github+json'}
+        if token:
+            self.headers['Authorization'] = f'token {token}'
+
+    def get(self, url, params=None):
+        """Get a resource, returning its json and the links to other pages of it."""
+        resp = self.session.get(url, params=params, headers=self.headers)
+        if not resp.ok:
+            raise RuntimeError(f'Error getting {url}: {resp.status_code} {resp.json()}')
+        links = {link['rel']: link['url']
+                 for link in parse_header_links(resp.headers.get('Link', ''))}
+        return resp.json(), links
+
+    def first_page(self, org, repo, since=None):
+        """Get the repository, the first page of its issues, and how many pages there are."""
+        repository, _ = self.get(f'{API}/repos/{org}/{repo}')
+        params = issue_params(since)
+        issues, links = self.get(f'{API}/repos/{org}/{repo}/issues', params)
+        # The link to the last page gives the page count, so the rest can be had at once
+        pages = int(parse_qs(urlsplit(links['last']).query)['page'][0]) if 'last' in links else 1
+        return repository, issues, pages
+
+    def page(self, org, repo, page, since=None):
+        params = dict(issue_params(since), page=page)
+        issues, _ = self.get(f'{API}/repos/{org}/{repo}/issues', params)
+        return issues
+
+
+def issue_params(since=None):
+    # Oldest first, so that anything updated while we list ends up at the end
+    params = {'state': 'all', 'sort': 'updated', 'direction': 'asc', 'per_page': PER_PAGE}
+    if since:
+        params['since'] = since
+    return params
+
+
+class Checkpoint:
+    """Issues already sent, with when they were last updated, saved to a file as we go."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._done = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self._done = json.load(f)
+
+    def is_done(self, key, issue):
+        return self._done.get(key, '') >= issue['updated_at']
+
+    def add(self, done):
+        """Record (key, updated_at) pairs as sent and save."""
+        with self._lock:
+            self._done.update(done)
+            if self.path:
+                # Replace the file in one go, so an interruption can't leave half of it
+                with open(self.path + '.tmp', 'w') as f:
+                    json.dump(self._done, f)
+                os.replace(self.path + '.tmp', self.path)
+
+
+class SNSPublisher:
+    """Send messages through SNS, to be synced by the message handler."""
+
+    batch_size = SNS_BATCH_SIZE
+    batch_bytes = SNS_BATCH_BYTES
+    workers = None
+
+    def __init__(self, topic):
+        self.topic = topic
+        self.sns = botocore.session.get_session().create_client('sns')
+
+    def __call__(self, messages):
+        """Publish (key, message) pairs, returning the keys of those that went."""
+        entries = [{'Id': str(i), 'Message': message} for i, (_, message) in enumerate(messages)]
+        resp = self.sns.publish_batch(TopicArn=self.topic, PublishBatchRequestEntries=entries)
+        for failed in resp['Failed']:
+            logger.warning('Failed to publish %s: %s', messages[int(failed['Id'])][0],
+                           failed.get('Message', failed['Code']))
+        return [messages[int(sent['Id'])][0] for sent in resp['Successful']]
+
+
+class DirectSync:
+    """Sync messages straight to Asana, as the message handler would."""
+
+    batch_size = DIRECT_BATCH_SIZE
+    batch_bytes = None
+    # sync_messages works on a batch concurrently itself
+    workers = 1
+
+    def __init__(self, concurrency, token=None):
+        import sync
+        self.sync = sync
+        # sync only reads $GITHUB_TOKEN when imported, so pass on one from --token-file too
+        if token:
+            sync.GITHUB_API_HEADERS['Authorization'] = f'token {token}'
+        self.concurrency = concurrency
+        self.client = sync.get_asana_client()
+
+    def __call__(self, messages):
+        failed = set(self.sync.sync_messages(self.client, messages, self.concurrency))
+        self.sync.directory.save()
+        self.sync.synced.save()
+        return [key for key, _ in messages if key not in failed]
+
+    def finish(self):
+        # Saves of what was synced are spaced out; don't leave the last ones unsaved
+        self.sync.synced.save(force=True)
+
+
+def batches(messages, size, max_bytes=None):
+    """Split (key, message) pairs into lists of up to size messages and max_bytes."""
+    batch = []
+    total = 0
+    for key, message in messages:
+        length = len(message.encode('utf-8'))
+        if batch and (len(batch) == size or (max_bytes and total + length > max_bytes)):
+            yield batch
+            batch = []
+            total = 0
+        batch.append((key, message))
+        total += length
+    if batch:
+        yield batch
+
+
+def to_payload(organization, repository, issue):
+    """Make the payload for an issue listed from the REST API, in the hook's compact form.
+
+    The listing has everything that is synced for a pull request too, so it
+    stands in for the pull request object rather than fetching each one.
+    """
+    payload = {'action': 'backfill', 'organization': organization, 'repository': repository}
+    payload['pull_request' if 'pull_request' in issue else 'issue'] = issue
+    return compact(payload)
+
+
+def backfill(github, org, repos, send, checkpoint, since=None, concurrency=8):
+    """Send every issue in repos updated since a time, skipping those already done.
+
+    Returns the number of issues sent and how many failed.
+    """
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        organization, _ = github.get(f'{API}/orgs/{org}')
+        firsts = dict(zip(repos, executor.map(lambda repo: github.first_page(org, repo, since),
+                                              repos)))
+        rest = [(repo, page) for repo, (_, _, pages) in firsts.items()
+                for page in range(2, pages + 1)]
+        listing = [(repo, issues) for repo, (_, issues, _) in firsts.items()]
+        listing.extend(zip((repo for repo, _ in rest),
+                           executor.map(lambda item: github.page(org, *item, since=since), rest)))
+
+        # Anything updated while we were listing may show up twice; send it once
+        messages = {}
+        updated = {}
+        listed = dict.fromkeys(repos, 0)
+        for repo, issues in listing:
+            repository = firsts[repo][0]
+            for issue in issues:
+                listed[repo] += 1
+                key = f'{org}/{repo}#{issue["number"]}'
+                if checkpoint.is_done(key, issue):
+                    continue
+                updated[key] = issue['updated_at']
+                messages[key] = json.dumps(to_payload(organization, repository, issue))
+        for repo, count in listed.items():
+            logger.info('%s/%s: %d issues', org, repo, count)
+        logger.info('%d to send, %d already done', len(messages),
+                    sum(listed.values()) - len(messages))
+
+        def send_batch(batch):
+            sent = send(batch)
+            checkpoint.add((key, updated[key]) for key in sent)
+            return len(batch) - len(sent)
+
+        workers = send.workers or concurrency
+        with ThreadPoolExecutor(max_workers=workers) as senders:
+            failed = sum(senders.map(send_batch, batches(messages.items(), send.batch_size,
+                                                         send.batch_bytes)))
+    return len(messages) - failed, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('repos', nargs='*', default=REPOS,
+                        help='Repositories to backfill (default: %(default)s)')
+    parser.add_argument('--org', default='Unidata', help='GitHub organization')
+    parser.add_argument('--since', help='Only issues updated since this (ISO 8601) time')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='Requests to make at once')
+    parser.add_argument('--token-file', help='File with a GitHub token (default: $GITHUB_TOKEN)')
+    parser.add_argument('--topic', default=os.environ.get('SNS_TOPIC_NAME'),
+                        help='SNS topic to publish to (default: $SNS_TOPIC_NAME)')
+    parser.add_argument('--direct', action='store_true',
+                        help='Sync to Asana directly rather than publishing to SNS')
+    parser.add_argument('--checkpoint', default='backfill_checkpoint.json',
+                        help='File to keep progress in, to resume from')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s %(message)s')
+    logger.setLevel(logging.INFO)
+
+    token = os.environ.get('GITHUB_TOKEN')
+    if args.token_file:
+        with open(args.token_file) as f:
+            token = f.read().strip()
+    if not token:
+        logger.warning('No GitHub token, so only 60 requests an hour can be made.')
+
+    if args.direct:
+        send = DirectSync(args.concurrency, token)
+    elif args.topic:
+        send = SNSPublisher(args.topic)
+    else:
+        parser.error('Either --topic (or $SNS_TOPIC_NAME) or --direct is needed.')
+
+    start = time.perf_counter()
+    sent, failed = backfill(GitHub(token), args.org, args.repos, send,
+                            Checkpoint(args.checkpoint), since=args.since,
+                            concurrency=args.concurrency)
+    if args.direct:
+        send.finish()
+    logger.info('Sent %d issues in %.1fs; %d failed.', sent, time.perf_counter() - start, failed)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,533 @@
+"""In-process stand-ins for the services AsanaBot talks to.
+
+Each fake sleeps for a configurable latency per request and counts the
+requests made to it in a shared `Calls` counter, keyed by service and
+operation, so that benchmarks can report how many round trips a code path
+costs.
+"""
+from collections import Counter, deque
+import io
+import itertools
+import json
+import threading
+import time
+import urllib.error
+import urllib.parse
+
+import asana
+import asana.client
+import requests
+
+
+class Calls:
+    """Thread-safe counter of requests made to each service."""
+
+    def __init__(self):
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, service, op):
+        with self._lock:
+            self._counts[service, op] += 1
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+    def by_service(self):
+        """Total requests for each service."""
+        totals = Counter()
+        for (service, _), count in self._counts.items():
+            totals[service] += count
+        return dict(totals)
+
+    def by_operation(self):
+        """Requests for each 'service.operation'."""
+        return {f'{service}.{op}': count for (service, op), count in sorted(self._counts.items())}
+
+
+class Service:
+    """Base for fakes: count a request and wait out the latency.
+
+    Like botocore, handlers can be registered for 'before-call' and
+    'after-call' events around each request.
+    """
+
+    name = None
+
+    def __init__(self, calls, latency=0):
+        self.calls = calls
+        self.latency = latency
+        self.events = _Events()
+
+    def _request(self, op):
+        context = {}
+        self.events.emit('before-call', context=context)
+        self.calls.add(self.name, op)
+        if self.latency:
+            time.sleep(self.latency)
+        self.events.emit('after-call', http_response=_Resource(status_code=200),
+                         model=_Resource(name=op), context=context)
+
+
+class _Events:
+    def __init__(self):
+        self._handlers = []
+
+    def register(self, name, handler):
+        self._handlers.append((name.split('.')[0], handler))
+
+    def emit(self, event, **kwargs):
+        for name, handler in self._handlers:
+            if name == event:
+                handler(**kwargs)
+
+
+def _client_meta(service):
+    """The parts of a boto3 client's meta that get used."""
+    return _Resource(service_model=_Resource(service_name=service.name), events=service.events)
+
+
+def _error(status):
+    """Make the asana error the real client would raise for a status."""
+    return asana.client.STATUS_MAP[status]()
+
+
+class FakeAsana(Service):
+    """Enough of `asana.Client` for AsanaBot, backed by dictionaries.
+
+    Collections are paginated with ``page_size`` items per request, like the
+    real client's iterators.
+    """
+
+    name = 'asana'
+
+    def __init__(self, calls, latency=0, page_size=50, workspaces=(), projects=(),
+                 users=(), tags=(), sections=()):
+        super().__init__(calls, latency)
+        self.page_size = page_size
+        self._gids = itertools.count(1000)
+        self._lock = threading.Lock()
+        self.workspace_list = [self._record(name) for name in workspaces]
+        self.project_list = [self._record(name) for name in projects]
+        self.user_list = [self._record(name) for name in users]
+        self.tag_list = [self._record(name) for name in tags]
+        self.section_list = [self._record(name) for name in sections]
+        self.task_store = {}
+        self.external = {}
+        self.headers = {}
+        self.options = dict(asana.Client.DEFAULT_OPTIONS)
+        self.session = _FakeOAuthSession()
+
+        self.workspaces = _Resource(find_all=lambda *args, **kwargs: self._pages(
+            'workspaces.find_all', self.workspace_list))
+        self.projects = _Resource(find_all=lambda *args, **kwargs: self._pages(
+            'projects.find_all', self.project_list))
+        self.users = _Resource(find_by_workspace=lambda *args, **kwargs: self._pages(
+            'users.find_by_workspace', self.user_list))
+        self.tags = _Resource(find_by_workspace=lambda *args, **kwargs: self._pages(
+            'tags.find_by_workspace', self.tag_list),
+            create_in_workspace=self._create_tag)
+        self.sections = _Resource(find_by_project=lambda *args, **kwargs: self._pages(
+            'sections.find_by_project', self.section_list))
+        self.tasks = _Resource(find_by_project=self._tasks_in_project)
+        self.batch_api = _Resource(create_batch_request=self._batch)
+
+    def _record(self, name):
+        return {'gid': str(next(self._gids)), 'name': name}
+
+    def _pages(self, op, items, page_size=None):
+        page_size = page_size or self.page_size
+        for start in range(0, max(len(items), 1), page_size):
+            self._request(op)
+            yield from items[start:start + page_size]
+
+    def _create_tag(self, workspace, params, **options):
+        self._request('tags.create_in_workspace')
+        tag = self._record(params['name'])
+        self.tag_list.append(tag)
+        return tag
+
+    def _tasks_in_project(self, project, params=None, **options):
+        return self._pages('tasks.find_by_project',
+                           [dict(task) for task in self.task_store.values()
+                            if project in task['projects']],
+                           options.get('page_size'))
+
+    def _batch(self, params, **options):
+        self._request('batch')
+        results = []
+        for action in params['actions']:
+            try:
+                body = self._dispatch(action['method'], action['relative_path'],
+                                      action.get('data'))
+                results.append({'status_code': 200, 'body': {'data': body}})
+            except asana.error.AsanaError as e:
+                results.append({'status_code': e.status,
+                                'body': {'errors': [{'message': e.message}]}})
+        return results
+
+    # The generic request methods used by sync.AsanaBatch
+    def get(self, path, query, **options):
+        self._request('get')
+        return self._dispatch('get', path, None)
+
+    def post(self, path, data, **options):
+        self._request('post')
+        return self._dispatch('post', path, data)
+
+    def put(self, path, data, **options):
+        self._request('put')
+        return self._dispatch('put', path, data)
+
+    def _dispatch(self, method, path, data):
+        parts = path.strip('/').split('/')
+        with self._lock:
+            if method == 'post' and parts[0] == 'workspaces' and parts[2] == 'tasks':
+                return self._create_task(data)
+            if parts[0] == 'tasks':
+                task = self._find_task(parts[1])
+                if method == 'get':
+                    return dict(task)
+                if method == 'put':
+                    task.update(self._task_fields(data))
+                    task['modified_at'] = _now()
+                    return dict(task)
+        raise _error(400)
+
+    def _find_task(self, task_id):
+        if task_id.startswith('external:'):
+            task_id = self.external.get(task_id[len('external:'):])
+        if task_id not in self.task_store:
+            raise _error(404)
+        return self.task_store[task_id]
+
+    def _create_task(self, data):
+        external = data.get('external', {}).get('gid')
+        if external in self.external:
+            raise _error(400)
+        gid = str(next(self._gids))
+        task = {'gid': gid, 'name': data.get('name'), 'notes': data.get('notes'),
+                'projects': list(data.get('projects', [])), 'assignee': None,
+                'completed': False, 'external': {'gid': external}}
+        task.update(self._task_fields(data))
+        task['modified_at'] = _now()
+        self.task_store[gid] = task
+        if external:
+            self.external[external] = gid
+        return dict(task)
+
+    @staticmethod
+    def _task_fields(data):
+        fields = {}
+        if 'assignee' in data:
+            assignee = data['assignee']
+            fields['assignee'] = (None if assignee in (None, 'null')
+                                  else {'gid': assignee['gid'] if isinstance(assignee, dict)
+                                        else assignee})
+        if 'completed' in data:
+            fields['completed'] = data['completed']
+        return fields
+
+
+class _Resource:
+    """A bag of methods, standing in for one of the client's resources."""
+
+    def __init__(self, **methods):
+        self.__dict__.update(methods)
+
+
+class _FakeOAuthSession:
+    token = {'access_token': 'fake'}
+
+    def request(self, method, url, **kwargs):
+        raise NotImplementedError('FakeAsana does not make HTTP requests')
+
+    def refresh_token(self, *args, **kwargs):
+        return self.token
+
+
+class FakeResponse:
+    """Just enough of a `requests.Response`."""
+
+    def __init__(self, status_code, data=None, headers=None):
+        self.status_code = status_code
+        self._data = data
+        self.headers = headers or {}
+        self.ok = status_code < 400
+
+    @property
+    def links(self):
+        return {link['rel']: link for link in requests.utils.parse_header_links(
+            self.headers.get('Link', ''))}
+
+    def json(self):
+        return self._data
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.HTTPError(f'{self.status_code} error', response=self)
+
+
+class FakeGitHub(Service):
+    """A stand-in `requests.Session` serving GitHub REST resources by URL.
+
+    Responses carry an ETag and honor If-None-Match with a 304. Lists of
+    issues are filtered by ``since`` and paginated with Link headers.
+    """
+
+    name = 'github'
+
+    def __init__(self, calls, latency=0):
+        super().__init__(calls, latency)
+        self.resources = {}
+        self.lists = {}
+
+    def add(self, url, data):
+        self.resources[url] = data
+
+    def add_list(self, url, items):
+        self.lists[url] = items
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def request(self, method, url, headers=None, params=None, **kwargs):
+        headers = headers or {}
+        # Links to further pages have their parameters in the url
+        url, _, query = url.partition('?')
+        params = dict(urllib.parse.parse_qsl(query), **(params or {}))
+        path = urllib.parse.urlsplit(url).path.strip('/').split('/')
+        self._request(path[0] if path[0] in ('users', 'orgs') or len(path) == 3 else path[-1])
+        if url in self.lists:
+            return self._page(url, params)
+        if url not in self.resources:
+            return FakeResponse(404, {'message': 'Not Found'})
+        data = self.resources[url]
+        etag = '"{:x}"'.format(hash(json.dumps(data, sort_keys=True)) & 0xffffffff)
+        if headers.get('If-None-Match') == etag:
+            return FakeResponse(304, None, {'ETag': etag})
+        return FakeResponse(200, data, {'ETag': etag})
+
+    def _page(self, url, params):
+        items = sorted((item for item in self.lists[url]
+                        if item['updated_at'] >= params.get('since', '')),
+                       key=lambda item: item['updated_at'])
+        per_page = int(params.get('per_page', 30))
+        page = int(params.get('page', 1))
+        last = max(1, -(-len(items) // per_page))
+        links = []
+        for rel, number in (('next', page + 1), ('last', last)):
+            if page < last:
+                query = urllib.parse.urlencode(dict(params, page=number))
+                links.append(f'<{url}?{query}>; rel="{rel}"')
+        return FakeResponse(200, items[(page - 1) * per_page:page * per_page],
+                            {'Link': ', '.join(links)} if links else {})
+
+
+class FakeS3(Service):
+    """A stand-in for the S3 client, keeping objects in memory."""
+
+    name = 's3'
+
+    def __init__(self, calls, latency=0, objects=None):
+        super().__init__(calls, latency)
+        self.objects = dict(objects or {})
+        self.exceptions = _Resource(NoSuchKey=NoSuchKey)
+        self.meta = _client_meta(self)
+
+    def get_object(self, Bucket, Key):
+        self._request('GetObject')
+        if (Bucket, Key) not in self.objects:
+            raise NoSuchKey(Key)
+        return {'Body': io.BytesIO(self.objects[Bucket, Key])}
+
+    def put_object(self, Bucket, Key, Body):
+        self._request('PutObject')
+        self.objects[Bucket, Key] = Body.encode('utf-8') if isinstance(Body, str) else Body
+
+
+class NoSuchKey(Exception):
+    pass
+
+
+class FakeBotocoreSession:
+    """Hands out the stand-in clients in place of a botocore session."""
+
+    def __init__(self, clients):
+        self.clients = clients
+
+    def create_client(self, name, *args, **kwargs):
+        return self.clients[name]
+
+
+class FakeSSM(Service):
+    """A stand-in for the boto3 SSM client."""
+
+    name = 'ssm'
+
+    def __init__(self, calls, latency=0, parameters=None):
+        super().__init__(calls, latency)
+        self.parameters = dict(parameters or {})
+        self.exceptions = _Resource(ParameterNotFound=ParameterNotFound)
+        self.meta = _client_meta(self)
+
+    def get_parameter(self, Name, WithDecryption=False):
+        self._request('GetParameter')
+        if Name not in self.parameters:
+            raise ParameterNotFound(Name)
+        return {'Parameter': {'Name': Name, 'Value': self.parameters[Name]}}
+
+
+class ParameterNotFound(Exception):
+    pass
+
+
+class FakeSNS(Service):
+    """A stand-in for the boto3 SNS client that keeps what is published."""
+
+    name = 'sns'
+
+    def __init__(self, calls, latency=0):
+        super().__init__(calls, latency)
+        self.published = []
+        self.subscribers = []
+        self._ids = itertools.count(1)
+        self.meta = _client_meta(self)
+
+    def publish(self, TopicArn, Message, **kwargs):
+        self._request('Publish')
+        message_id = 'msg-{}'.format(next(self._ids))
+        self.published.append(dict(TopicArn=TopicArn, Message=Message, MessageId=message_id,
+                                   **kwargs))
+        for subscriber in self.subscribers:
+            subscriber.deliver(TopicArn, message_id, Message, kwargs.get('MessageAttributes'))
+        return {'MessageId': message_id}
+
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        self._request('PublishBatch')
+        successful = []
+        for entry in PublishBatchRequestEntries:
+            message_id = 'msg-{}'.format(next(self._ids))
+            self.published.append(dict(TopicArn=TopicArn, MessageId=message_id, **entry))
+            for subscriber in self.subscribers:
+                subscriber.deliver(TopicArn, message_id, entry['Message'],
+                                   entry.get('MessageAttributes'))
+            successful.append({'Id': entry['Id'], 'MessageId': message_id})
+        return {'Successful': successful, 'Failed': []}
+
+
+class LocalQueue:
+    """An in-memory stand-in for an SQS queue, and for Lambda's polling of it.
+
+    Subscribed to a `FakeSNS`, messages published arrive wrapped in SNS's
+    envelope, as they do without raw message delivery. `receive` makes the
+    event a handler is invoked with, and `complete` takes the handler's
+    partial batch response: the messages that succeeded are deleted, and the
+    rest become visible again, until they have been received
+    ``max_receives`` times and go to `dead_letters`.
+    """
+
+    arn = 'arn:aws:sqs:us-east-1:123456789012:GitHubMessageQueue'
+
+    def __init__(self, max_receives=5):
+        self.max_receives = max_receives
+        self.dead_letters = []
+        self._waiting = deque()
+        self._in_flight = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._waiting) + len(self._in_flight)
+
+    def deliver(self, topic, message_id, message, attributes=None):
+        """Queue a message published to an SNS topic."""
+        envelope = {'Type': 'Notification', 'MessageId': message_id, 'TopicArn': topic,
+                    'Message': message}
+        if attributes:
+            envelope['MessageAttributes'] = {
+                name: {'Type': attr['DataType'], 'Value': attr['StringValue']}
+                for name, attr in attributes.items()}
+        self.send(json.dumps(envelope))
+
+    def send(self, body, attributes=None):
+        """Queue a message, as SendMessage would."""
+        record = {'messageId': 'sqs-{}'.format(next(self._ids)), 'body': body,
+                  'attributes': {'ApproximateReceiveCount': '0'},
+                  'messageAttributes': {name: {'dataType': 'String', 'stringValue': value}
+                                        for name, value in (attributes or {}).items()},
+                  'eventSource': 'aws:sqs', 'eventSourceARN': self.arn}
+        with self._lock:
+            self._waiting.append(record)
+
+    def receive(self, max_messages=10):
+        """Take up to max_messages off the queue, as the event for a handler."""
+        records = []
+        with self._lock:
+            while self._waiting and len(records) < max_messages:
+                record = self._waiting.popleft()
+                received = int(record['attributes']['ApproximateReceiveCount']) + 1
+                record = dict(record, attributes={'ApproximateReceiveCount': str(received)})
+                self._in_flight[record['messageId']] = record
+                records.append(record)
+        return {'Records': records}
+
+    def complete(self, event, response=None):
+        """Finish with a received batch; no response means the handler raised."""
+        if response is None:
+            failed = {record['messageId'] for record in event['Records']}
+        else:
+            failed = {item['itemIdentifier'] for item in response['batchItemFailures']}
+        with self._lock:
+            for record in event['Records']:
+                record = self._in_flight.pop(record['messageId'])
+                if record['messageId'] not in failed:
+                    continue
+                if int(record['attributes']['ApproximateReceiveCount']) >= self.max_receives:
+                    self.dead_letters.append(record)
+                else:
+                    self._waiting.append(record)
+
+    def drain(self, handler, batch_size=10):
+        """Invoke handler on batches until the queue is empty, returning the invocations."""
+        invocations = 0
+        while len(self):
+            event = self.receive(batch_size)
+            invocations += 1
+            try:
+                response = handler(event, None)
+            except Exception:
+                response = None
+            self.complete(event, response)
+        return invocations
+
+
+class FakeFeeds(Service):
+    """A stand-in for `urllib.request.urlopen` serving Stack Overflow tag feeds."""
+
+    name = 'stackoverflow'
+
+    def __init__(self, calls, latency=0):
+        super().__init__(calls, latency)
+        self.feeds = {}
+
+    def urlopen(self, req, timeout=None):
+        self._request('feed')
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(req.full_url).query)
+        content = self.feeds[query['tagnames'][0]]
+        etag = '"{:x}"'.format(hash(content) & 0xffffffff)
+        if req.get_header('If-none-match') == etag:
+            raise urllib.error.HTTPError(req.full_url, 304, 'Not Modified', {}, None)
+        return _FakeFeedResponse(content, {'ETag': etag})
+
+
+class _FakeFeedResponse(io.BytesIO):
+    def __init__(self, content, headers):
+        super().__init__(content)
+        self.headers = headers
+
+
+def _now():
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
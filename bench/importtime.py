@@ -0,0 +1,95 @@
+"""Measure how long it takes to import each Lambda handler's module.
+
+Each module is imported in a fresh interpreter with ``python -X importtime``
+(the best of several runs is kept, as timings are noisy). The modules each
+handler pulls in, and the time taken, can be saved and compared later to
+catch cold start regressions::
+
+    python bench/importtime.py --save bench/importtime.json
+    python bench/importtime.py --compare bench/importtime.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CODE = os.path.join(os.path.dirname(HERE), 'code')
+
+HANDLERS = ['githubhook', 'sync', 'stackoverflow']
+
+
+def import_time(module):
+    """Import module in a new interpreter, returning {imported module: cumulative us}."""
+    env = dict(os.environ, PYTHONPATH=CODE, AWS_DEFAULT_REGION='us-east-1')
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                          env=env, capture_output=True, text=True, check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def measure(module, runs):
+    """Find the modules imported, and the best total time in ms, over several runs."""
+    best = None
+    modules = set()
+    for _ in range(runs):
+        times = import_time(module)
+        modules.update(times)
+        if best is None or times[module] < best:
+            best = times[module]
+    return {'ms': best / 1000, 'modules': sorted(modules)}
+
+
+def compare(results, baseline, tolerance):
+    """Find handlers that import more modules, or take longer, than in a baseline."""
+    regressions = []
+    for module, result in results.items():
+        before = baseline.get(module)
+        if before is None:
+            continue
+        added = sorted(set(result['modules']) - set(before['modules']))
+        if added:
+            regressions.append(f'{module}: now imports {", ".join(added)}')
+        if result['ms'] > before['ms'] * (1 + tolerance):
+            regressions.append(f'{module}: {before["ms"]:.1f}ms -> {result["ms"]:.1f}ms')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('modules', nargs='*', choices=[[]] + HANDLERS,
+                        help='Modules to import (default: all)')
+    parser.add_argument('--runs', type=int, default=5, help='Imports of each module to try')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='Fraction slower than the baseline to allow')
+    parser.add_argument('--save', metavar='FILE', help='Save results to FILE')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='Fail if any import is slower, or imports more, than in FILE')
+    args = parser.parse_args(argv)
+
+    results = {module: measure(module, args.runs) for module in (args.modules or HANDLERS)}
+    print(f'{"module":<16}{"import(ms)":>12}{"modules":>10}')
+    for module, result in results.items():
+        print(f'{module:<16}{result["ms"]:>12.1f}{len(result["modules"]):>10}')
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('Regression:', regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
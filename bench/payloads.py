@@ -0,0 +1,130 @@
+"""Synthetic GitHub webhook payloads, Lambda events and Stack Overflow feeds."""
+import hashlib
+import hmac
+import json
+import time
+import zlib
+
+API = 'https://api.github.com'
+
+
+def user_url(login):
+    return f'{API}/users/{login}'
+
+
+def milestones_url(org, repo):
+    return f'{API}/repos/{org}/{repo}/milestones'
+
+
+def user(login, name):
+    """The GitHub API resource for a user."""
+    return {'login': login, 'url': user_url(login), 'name': name, 'type': 'User'}
+
+
+def repository(org, repo):
+    return {'name': repo, 'full_name': f'{org}/{repo}', 'private': False,
+            'url': f'{API}/repos/{org}/{repo}',
+            'milestones_url': milestones_url(org, repo) + '{/number}',
+            'description': 'A repository ' * 10}
+
+
+def issue_event(org, repo, number, action, state='open', assignee=None, reviewers=(),
+                is_pr=False, body_size=2000, milestone=None):
+    """Make the body of an issues or pull_request webhook delivery."""
+    kind = 'pull' if is_pr else 'issues'
+    nested = {'number': number, 'title': f'Fix the thing number {number}',
+              'state': state, 'milestone': milestone,
+              'html_url': f'https://github.com/{org}/{repo}/{kind}/{number}',
+              'body': ('Lorem ipsum dolor sit amet. ' * (body_size // 28 + 1))[:body_size],
+              'user': {'login': 'someone', 'url': user_url('someone')},
+              'assignee': {'login': assignee, 'url': user_url(assignee)} if assignee else None,
+              'assignees': [{'login': assignee, 'url': user_url(assignee)}] if assignee else [],
+              'labels': [{'name': 'Type: Bug', 'color': 'ff0000'}],
+              'created_at': '2024-01-01T00:00:00Z', 'updated_at': '2024-01-02T00:00:00Z'}
+    if is_pr:
+        nested['requested_reviewers'] = [{'login': r, 'url': user_url(r)} for r in reviewers]
+        nested['head'] = {'ref': 'feature', 'sha': '0' * 40}
+        nested['base'] = {'ref': 'main', 'sha': '1' * 40}
+
+    payload = {'action': action,
+               'organization': {'login': org, 'url': f'{API}/orgs/{org}'},
+               'repository': repository(org, repo),
+               'sender': {'login': 'someone', 'url': user_url('someone')}}
+    payload['pull_request' if is_pr else 'issue'] = nested
+    return payload
+
+
+def organization(org):
+    return {'login': org, 'url': f'{API}/orgs/{org}', 'description': 'An organization'}
+
+
+def issue(org, repo, number, state='open', assignee=None, is_pr=False, body_size=2000,
+          updated='2024-01-02T00:00:00Z'):
+    """The GitHub API resource for an issue (or pull request) as listed from a repository.
+
+    With no body_size, the issue has no description, which GitHub lists as a null body.
+    """
+    kind = 'pull' if is_pr else 'issues'
+    data = {'number': number, 'title': f'Fix the thing number {number}', 'state': state,
+            'milestone': None, 'html_url': f'https://github.com/{org}/{repo}/{kind}/{number}',
+            'body': (None if body_size is None
+                     else ('Lorem ipsum dolor sit amet. ' * (body_size // 28 + 1))[:body_size]),
+            'user': {'login': 'someone', 'url': user_url('someone')},
+            'assignee': {'login': assignee, 'url': user_url(assignee)} if assignee else None,
+            'labels': [], 'created_at': '2024-01-01T00:00:00Z', 'updated_at': updated}
+    if is_pr:
+        data['pull_request'] = {'url': f'{API}/repos/{org}/{repo}/pulls/{number}'}
+    return data
+
+
+def sns_event(bodies, deliveries=None):
+    """Make the event the message handler gets from SNS for some webhook bodies.
+
+    deliveries, if given, are the GitHub delivery ids to attach to each.
+    """
+    records = []
+    for i, body in enumerate(bodies):
+        sns = {'MessageId': f'sns-{i}', 'Message': json.dumps(body)}
+        if deliveries:
+            sns['MessageAttributes'] = {'GitHubDelivery': {'Type': 'String',
+                                                           'Value': deliveries[i]}}
+        records.append({'EventSource': 'aws:sns', 'Sns': sns})
+    return {'Records': records}
+
+
+def api_gateway_event(body, secret, event_type='issues', delivery='delivery-1'):
+    """Make the API Gateway event for a signed webhook delivery."""
+    text = json.dumps(body)
+    sig = hmac.new(secret.encode('ascii'), text.encode('utf-8'), hashlib.sha1).hexdigest()
+    return {'headers': {'X-Hub-Signature': f'sha1={sig}', 'X-GitHub-Event': event_type,
+                        'X-GitHub-Delivery': delivery},
+            'body': text}
+
+
+def atom_feed(tag, count, newest, step=60):
+    """Make a Stack Overflow tag feed with count questions, newest first.
+
+    newest is an epoch time for the first entry; each one after is step seconds older.
+    """
+    def stamp(t):
+        return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(t))
+
+    entries = []
+    for i in range(count):
+        qid = 70000000 + zlib.crc32(f'{tag}-{i}'.encode()) % 1000000
+        entries.append(
+            '<entry>'
+            f'<id>https://stackoverflow.com/q/{qid}</id>'
+            f'<title type="text">How do I use {tag} for thing {i}?</title>'
+            f'<category scheme="https://stackoverflow.com/tags" term="{tag}" />'
+            '<author><name>someone</name></author>'
+            f'<published>{stamp(newest - i * step)}</published>'
+            f'<updated>{stamp(newest - i * step)}</updated>'
+            f'<summary type="html">{"I tried some things and they did not work. " * 20}</summary>'
+            '</entry>')
+    return ('<?xml version="1.0" encoding="utf-8"?>'
+            '<feed xmlns="http://www.w3.org/2005/Atom">'
+            f'<title type="text">Newest questions tagged {tag}</title>'
+            f'<updated>{stamp(newest)}</updated>'
+            f'<id>https://stackoverflow.com/feeds/tag/{tag}</id>'
+            + ''.join(entries) + '</feed>').encode('utf-8')
@@ -0,0 +1,340 @@
+"""Benchmark AsanaBot's handlers offline, against in-process stand-ins.
+
+Each scenario is run twice: ``cold``, importing the modules afresh as on a
+new Lambda container, and ``warm``, reusing them for a second, similar event.
+For each run we report wall time, peak memory and the number of requests
+made to each service. Request counts can be saved and compared later to
+catch regressions::
+
+    python bench/run.py --save bench/baseline.json
+    python bench/run.py --compare bench/baseline.json
+"""
+import argparse
+from contextlib import ExitStack, redirect_stdout
+import importlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from unittest import mock
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'code'))
+sys.path.insert(0, HERE)
+
+import asana  # noqa: E402
+import botocore.session  # noqa: E402
+import requests  # noqa: E402
+import urllib.request  # noqa: E402
+
+import fakes  # noqa: E402
+import payloads  # noqa: E402
+
+ORG = 'Unidata'
+REPOS = ['MetPy', 'siphon', 'python-gallery', 'python-workshop']
+SECRET = 'not-so-secret'
+TOPIC = 'arn:aws:sns:us-east-1:000000000000:GitHubMessagePipe'
+NOW = 1700000000
+ISSUES_PER_REPO = 500
+
+
+class World:
+    """One set of stand-in services, with the data the handlers expect to find."""
+
+    def __init__(self, latency, page_size, users=300, projects=200, tags=20):
+        self.calls = fakes.Calls()
+        self.logins = [f'dev{i}' for i in range(users)]
+        names = [f'Developer {i}' for i in range(users)]
+        self.tags = [f'tag{i}' for i in range(tags)]
+
+        project_names = ([repo.replace('-', ' ') for repo in REPOS] + ['Python Support']
+                         + [f'Other project {i}' for i in range(projects)])
+        self.asana = fakes.FakeAsana(self.calls, latency, page_size,
+                                     workspaces=['Other', ORG], projects=project_names,
+                                     users=names, tags=['GitHub', 'StackOverflow'],
+                                     sections=['To do', 'Done'])
+        self.github = fakes.FakeGitHub(self.calls, latency)
+        for login, name in zip(self.logins, names):
+            self.github.add(payloads.user_url(login), payloads.user(login, name))
+        for repo in REPOS:
+            self.github.add(payloads.milestones_url(ORG, repo), [{'number': 1, 'title': 'v1'}])
+
+        # The history for backfills, with one issue a minute updated in each repository
+        self.github.add(f'{payloads.API}/orgs/{ORG}', payloads.organization(ORG))
+        for repo in REPOS:
+            self.github.add(f'{payloads.API}/repos/{ORG}/{repo}', payloads.repository(ORG, repo))
+            self.github.add_list(f'{payloads.API}/repos/{ORG}/{repo}/issues', [
+                payloads.issue(ORG, repo, number, state='closed' if number % 4 else 'open',
+                               assignee=self.logins[number % users] if number % 3 else None,
+                               is_pr=bool(number % 2), updated=_stamp(NOW - 60 * number),
+                               body_size=None if number % 10 == 0 else 2000)
+                for number in range(1, ISSUES_PER_REPO + 1)])
+        self.scratch = tempfile.TemporaryDirectory()
+
+        config = [{'tag': tag, 'updated': _stamp(NOW - 600), 'project': 'Python Support',
+                   'owner': names[0]} for tag in self.tags]
+        self.s3 = fakes.FakeS3(self.calls, latency, objects={
+            ('unidata-python', 'asanabot/asana_client'): json.dumps(
+                {'ASANA_CLIENT_ID': 'id', 'ASANA_CLIENT_SECRET': 'secret'}).encode(),
+            ('unidata-python', 'asanabot/asana_token'): json.dumps(
+                {'access_token': 'token', 'refresh_token': 'refresh'}).encode(),
+            ('unidata-python', 'asanabot/stackoverflow_config.json'): json.dumps(config).encode()})
+        self.ssm = fakes.FakeSSM(self.calls, latency,
+                                 parameters={'/asanabot/GitHubToken': SECRET,
+                                             '/asanabot/GitHubApiToken': 'api-token'})
+        self.sns = fakes.FakeSNS(self.calls, latency)
+        self.queue = fakes.LocalQueue()
+        self.sns.subscribers.append(self.queue)
+        self.feeds = fakes.FakeFeeds(self.calls, latency)
+        for tag in self.tags:
+            self.feeds.feeds[tag] = payloads.atom_feed(tag, 30, NOW)
+
+    def patches(self):
+        """Route the service clients the handlers create to the stand-ins."""
+        session = fakes.FakeBotocoreSession({'s3': self.s3, 'sns': self.sns, 'ssm': self.ssm})
+        return [mock.patch.object(botocore.session, 'get_session', lambda: session),
+                mock.patch.object(asana.Client, 'oauth', lambda **kwargs: self.asana),
+                mock.patch.object(requests, 'Session', lambda: self.github),
+                mock.patch.object(urllib.request, 'urlopen', self.feeds.urlopen),
+                mock.patch.dict(os.environ, {'SNS_TOPIC_NAME': TOPIC,
+                                             'GITHUB_TOKEN_PARAMETER': '/asanabot/GitHubApiToken'})]
+
+
+def _stamp(t):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(t))
+
+
+# The modules the handlers share, which must be fresh too so that nothing (like the
+# rate limits' buckets) carries over from one scenario to the next
+SHARED = ('metrics', 'ratelimit', 'idempotency', 'payload')
+
+
+def load_handlers():
+    """(Re-)import the handler modules, and those they share, as a cold start would."""
+    modules = {}
+    for name in SHARED + ('githubhook', 'sync', 'stackoverflow', 'backfill'):
+        if name in sys.modules:
+            modules[name] = importlib.reload(sys.modules[name])
+        else:
+            modules[name] = importlib.import_module(name)
+    return modules
+
+
+def _issue_events(world, start, count, assigned_every=3):
+    events = []
+    for i in range(count):
+        number = start + i
+        assignee = world.logins[number % len(world.logins)] if i % assigned_every == 0 else None
+        events.append(payloads.issue_event(ORG, REPOS[i % len(REPOS)], number, 'opened',
+                                           assignee=assignee, is_pr=bool(i % 2)))
+    return events
+
+
+def _pr_burst(world, number):
+    login = world.logins[number % len(world.logins)]
+    reviewer = world.logins[(number + 1) % len(world.logins)]
+    events = [payloads.issue_event(ORG, 'MetPy', number, 'opened', is_pr=True)]
+    events.append(payloads.issue_event(ORG, 'MetPy', number, 'assigned', assignee=login,
+                                       is_pr=True))
+    for action in ('review_requested', 'labeled', 'synchronize'):
+        events.append(payloads.issue_event(ORG, 'MetPy', number, action, assignee=login,
+                                           reviewers=[reviewer], is_pr=True))
+    return events
+
+
+def scenario_enqueue_event(world, handlers, run):
+    body = payloads.issue_event(ORG, 'MetPy', 1 + run, 'opened')
+    event = payloads.api_gateway_event(body, SECRET, delivery=f'delivery-{run}')
+    handlers['githubhook'].enqueue_event(event, None)
+
+
+def scenario_enqueue_ignored(world, handlers, run):
+    body = payloads.issue_event(ORG, 'MetPy', 1 + run, 'labeled')
+    event = payloads.api_gateway_event(body, SECRET, delivery=f'delivery-{run}')
+    handlers['githubhook'].enqueue_event(event, None)
+
+
+def scenario_single_event(world, handlers, run):
+    event = payloads.sns_event(_issue_events(world, 100 + run, 1))
+    handlers['sync'].process_payload(event, None)
+
+
+def scenario_sns_redelivery(world, handlers, run):
+    # The second run gets the same delivery again, as SNS or GitHub might send it
+    event = payloads.sns_event(_issue_events(world, 200, 1), deliveries=['delivery-200'])
+    handlers['sync'].process_payload(event, None)
+
+
+def scenario_replay(world, handlers, run):
+    # The second run is the same event again, without a delivery id to recognize it by
+    event = payloads.sns_event(_issue_events(world, 300, 1))
+    handlers['sync'].process_payload(event, None)
+
+
+def scenario_open_then_close(world, handlers, run):
+    # The second run closes the issue the first opened, so its task is already known
+    action, state = ('opened', 'open') if run == 0 else ('closed', 'closed')
+    body = payloads.issue_event(ORG, 'MetPy', 400, action, state=state)
+    handlers['sync'].process_payload(payloads.sns_event([body]), None)
+
+
+def scenario_sns_batch_100(world, handlers, run):
+    event = payloads.sns_event(_issue_events(world, 1000 + 100 * run, 100))
+    handlers['sync'].process_payload(event, None)
+
+
+def scenario_queue_batch_100(world, handlers, run):
+    # The same sort of events as sns_batch_100, through the queue 100 at a time
+    sync = handlers['sync']
+    for i, body in enumerate(_issue_events(world, 3000 + 100 * run, 100)):
+        attributes = {'GitHubDelivery': {'DataType': 'String',
+                                         'StringValue': f'delivery-{3000 + 100 * run + i}'}}
+        world.queue.deliver('arn:aws:sns:us-east-1:123456789012:GitHubMessagePipe',
+                            f'sns-{i}', json.dumps(body), attributes)
+    world.queue.drain(sync.process_queue, batch_size=100)
+
+
+def scenario_pr_burst(world, handlers, run):
+    event = payloads.sns_event(_pr_burst(world, 500 + run))
+    handlers['sync'].process_payload(event, None)
+
+
+def scenario_feed_poll_20(world, handlers, run):
+    handlers['stackoverflow'].check_stack_overflow(None, None)
+
+
+def scenario_feed_poll_updates(world, handlers, run):
+    # The second run finds the newest questions on a few tags updated since the first
+    if run:
+        for tag in world.tags[:5]:
+            world.feeds.feeds[tag] = payloads.atom_feed(tag, 30, NOW + 300)
+    handlers['stackoverflow'].check_stack_overflow(None, None)
+
+
+def scenario_reconcile_2000(world, handlers, run):
+    # The first run creates the missing tasks; the second should find nothing to do
+    handlers['sync'].reconcile_repos({'organization': ORG, 'repositories': REPOS}, None)
+
+
+def scenario_backfill_2000(world, handlers, run):
+    # The second run resumes from the first's checkpoint
+    backfill = handlers['backfill']
+    checkpoint = backfill.Checkpoint(os.path.join(world.scratch.name, 'checkpoint.json'))
+    backfill.backfill(backfill.GitHub(), ORG, REPOS, backfill.SNSPublisher(TOPIC), checkpoint)
+
+
+def scenario_backfill_direct_200(world, handlers, run):
+    backfill = handlers['backfill']
+    checkpoint = backfill.Checkpoint(os.path.join(world.scratch.name, 'checkpoint.json'))
+    send = backfill.DirectSync(4)
+    backfill.backfill(backfill.GitHub(), ORG, REPOS, send, checkpoint,
+                      since=_stamp(NOW - 60 * 50))
+    send.finish()
+
+
+SCENARIOS = {name[len('scenario_'):]: func for name, func in globals().items()
+             if name.startswith('scenario_')}
+
+
+def run_scenario(name, latency, page_size):
+    """Run a scenario cold and then warm, returning the measurements for each."""
+    world = World(latency, page_size)
+    results = {}
+    with ExitStack() as stack:
+        for patch in world.patches():
+            stack.enter_context(patch)
+        handlers = None
+        for run, label in enumerate(('cold', 'warm')):
+            world.calls.reset()
+            tracemalloc.start()
+            start = time.perf_counter()
+            # Keep the handlers' metric log lines out of the report
+            with redirect_stdout(io.StringIO()):
+                # Anything done at import is part of a cold start
+                if handlers is None:
+                    handlers = load_handlers()
+                SCENARIOS[name](world, handlers, run)
+            wall = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results[label] = {'wall': wall, 'peak_kib': peak / 1024,
+                              'calls': world.calls.by_service(),
+                              'operations': world.calls.by_operation()}
+    return results
+
+
+# Task requests go through AsanaBatch, whose timer decides how many go in each batch
+# and whether one goes on its own; how they split depends on thread timing, so only
+# their total is compared, with some tolerance where there were batches
+BATCHED = ('asana.batch', 'asana.get', 'asana.post', 'asana.put')
+
+
+def compare(results, baseline, tolerance=0.05):
+    """Find operations whose request counts went up compared to a baseline."""
+    regressions = []
+    for name, runs in results.items():
+        for label, result in runs.items():
+            before = baseline.get(name, {}).get(label, {}).get('operations', {})
+            for op, count in result['operations'].items():
+                if op not in BATCHED and count > before.get(op, 0):
+                    regressions.append(f'{name} ({label}): {op} {before.get(op, 0)} -> {count}')
+            count = sum(result['operations'].get(op, 0) for op in BATCHED)
+            allowed = sum(before.get(op, 0) for op in BATCHED)
+            if before.get('asana.batch'):
+                allowed += max(1, int(allowed * tolerance))
+            if count > allowed:
+                regressions.append(f'{name} ({label}): asana task requests {allowed} -> {count}')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('scenarios', nargs='*', choices=[[]] + sorted(SCENARIOS),
+                        help='Scenarios to run (default: all)')
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='Seconds each fake request takes')
+    parser.add_argument('--page-size', type=int, default=50,
+                        help='Items per page for Asana collections')
+    parser.add_argument('--json', action='store_true', help='Print results as json')
+    parser.add_argument('--save', metavar='FILE', help='Save results to FILE')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='Fail if any request count is higher than in FILE')
+    parser.add_argument('--tolerance', type=float, default=0.05,
+                        help='Fraction more batched Asana task requests than FILE to allow')
+    args = parser.parse_args(argv)
+
+    results = {name: run_scenario(name, args.latency, args.page_size)
+               for name in (args.scenarios or SCENARIOS)}
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        services = sorted({service for runs in results.values() for result in runs.values()
+                           for service in result['calls']})
+        print(f'{"scenario":<22}{"run":<6}{"wall(s)":>9}{"peak(KiB)":>11}'
+              + ''.join(f'{service:>15}' for service in services))
+        for name, runs in results.items():
+            for label, result in runs.items():
+                print(f'{name:<22}{label:<6}{result["wall"]:>9.3f}{result["peak_kib"]:>11.0f}'
+                      + ''.join(f'{result["calls"].get(service, 0):>15}'
+                                for service in services))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('Regression:', regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,27 +1,87 @@
 import hashlib
 import hmac
+import json
 import logging
 import os
 import secrets
+import time
 
-import boto3
+import botocore.session
+
+from idempotency import IdempotencyCache
+from metrics import metrics
+from payload import compact
 
 logger = logging.getLogger('asanabot')
 logger.setLevel(logging.INFO)
 
-sns = boto3.client('sns')
-ssm = boto3.client('ssm')
+# How long a warm container may keep using the webhook secret before re-reading it
+SECRET_TTL = float(os.environ.get('SECRET_CACHE_TTL', 300))
+
+# Don't let a stream of badly-signed requests hammer SSM with forced refreshes
+SECRET_MIN_REFRESH = 30
+
+# How long, in seconds, a warm container remembers deliveries it has already forwarded
+DELIVERY_TTL = float(os.environ.get('DELIVERY_CACHE_TTL', 3600))
+
+# The events, and their actions, that can change what is synced to Asana; anything
+# else is acknowledged without going any further
+SYNCED_ACTIONS = {
+    'issues': {'opened', 'reopened', 'closed', 'assigned', 'unassigned', 'milestoned',
+               'demilestoned'},
+    'pull_request': {'opened', 'reopened', 'closed', 'assigned', 'unassigned',
+                     'review_requested', 'review_request_removed', 'ready_for_review',
+                     'milestoned', 'demilestoned'}}
+
 
 def enqueue_event(event, context):
     """Handle getting an event from GitHub and putting it into the pipeline."""
+    metrics.reset()
+    ignored = False
     try:
         headers = event['headers']
         logger.debug('Headers: %s', headers)
         body = event['body']
         logger.debug('Body: %s', body)
+
+        # Turn away events we don't sync before doing any work for them; the event type
+        # is in a header, so that costs nothing. Unsigned requests are still refused.
+        event_type = headers.get('X-GitHub-Event')
+        if event_type not in SYNCED_ACTIONS:
+            if 'X-Hub-Signature' not in headers:
+                raise UnauthorizedError('Missing X-Hub-Signature header.')
+            logger.info('Ignoring %s event.', event_type)
+            ignored = True
+            return dict(statusCode=200, headers={'Content-Type': 'application/json'},
+                        body='Ignored')
+
         check_signature(headers, body)
-        msg = sns.publish(TopicArn=os.environ['SNS_TOPIC_NAME'], Message=body)
+
+        # Only a signed body is worth parsing
+        payload = relevant_payload(event_type, body)
+        if payload is None:
+            ignored = True
+            return dict(statusCode=200, headers={'Content-Type': 'application/json'},
+                        body='Ignored')
+
+        # GitHub redelivers; there's no need to pass along what we already have
+        delivery = headers.get('X-GitHub-Delivery')
+        if delivery and _deliveries.get(delivery):
+            logger.info('Already forwarded delivery %s.', delivery)
+            ignored = True
+            return dict(statusCode=200, headers={'Content-Type': 'application/json'},
+                        body=_deliveries.get(delivery))
+
+        message = json.dumps(compact(payload), separators=(',', ':'))
+        attributes = {}
+        if delivery:
+            # Carried along so that the message handler can skip repeats too
+            attributes['GitHubDelivery'] = {'DataType': 'String', 'StringValue': delivery}
+        msg = get_client('sns').publish(TopicArn=os.environ['SNS_TOPIC_NAME'], Message=message,
+                                        MessageAttributes=attributes)
         logger.info('Published as: %s', msg['MessageId'])
+        if delivery:
+            _deliveries.put(delivery, msg['MessageId'])
     except UnauthorizedError as e:
         logger.debug('Handling unauthorized access.')
         return dict(statusCode=401, headers={'Content-Type': 'application/json'},
@@ -29,27 +89,117 @@ def enqueue_event(event, context):
     except Exception as e:
         logger.exception('Exception:', exc_info=e)
         raise e
+    finally:
+        metrics.emit('githubhook', SecretCacheHits=_secret.hits, SecretCacheMisses=_secret.misses,
+                     Ignored=int(ignored))
     return dict(statusCode=200,
                 headers={'Content-Type': 'application/json'},
                 body=msg['MessageId'])
 
 
+def relevant_payload(event_type, body):
+    """Get the payload of a delivery of a synced event, or None if it's nothing we sync."""
+    try:
+        payload = json.loads(body)
+        action = payload['action']
+    except (ValueError, KeyError, TypeError) as e:
+        logger.info('Ignoring %s event without an action: %s', event_type, e)
+        return None
+
+    if action not in SYNCED_ACTIONS[event_type]:
+        logger.info('Ignoring %s event with action %s.', event_type, action)
+        return None
+
+    # Only organizations' repositories have a workspace to sync to
+    if not payload.get('organization'):
+        logger.info('Ignoring %s event outside of an organization.', event_type)
+        return None
+    return payload
+
+
+@metrics.timed('check_signature')
 def check_signature(headers, body):
     """Verify that the payload is properly signed."""
     if 'X-Hub-Signature' not in headers:
         raise UnauthorizedError('Missing X-Hub-Signature header.')
 
     alg, header_sig = headers['X-Hub-Signature'].split('=')
-    secret_key = ssm.get_parameter(Name='/asanabot/GitHubToken',
-                                   WithDecryption=True)['Parameter']['Value']
-    digest = hmac.HMAC(secret_key.encode('ascii'), body.encode('utf-8'),
-                       digestmod=getattr(hashlib, alg))
-    sig = digest.hexdigest()
+    sig = _secret.sign(alg, body)
     logger.debug('Comparing signatures. Got: %s Calculated: %s', header_sig, sig)
 
     if not secrets.compare_digest(header_sig, sig):
-        raise UnauthorizedError('Signatures do not match.')
+        # The secret may have been rotated since we cached it, so try once more
+        # with a fresh copy before rejecting.
+        sig = _secret.sign(alg, body, refresh=True)
+        if not secrets.compare_digest(header_sig, sig):
+            raise UnauthorizedError('Signatures do not match.')
+
+
+class SecretCache:
+    """Keep the webhook secret, and keyed HMAC objects, around in a warm container."""
+
+    def __init__(self, name, ttl):
+        self.name = name
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._expires = 0
+        self._loaded = float('-inf')
+        self._macs = {}
+        self._key = None
+
+    def sign(self, alg, body, refresh=False):
+        """Calculate the hex digest of body using the cached secret."""
+        now = time.monotonic()
+        if refresh and now - self._loaded < SECRET_MIN_REFRESH:
+            logger.debug('Secret refreshed recently, not refreshing again.')
+            self.hits += 1
+        elif refresh or now >= self._expires:
+            self._load()
+        else:
+            self.hits += 1
+        logger.info('Secret cache hits: %d misses: %d', self.hits, self.misses)
+
+        # Keying the HMAC is done once per secret and algorithm; copying is cheap
+        if alg not in self._macs:
+            self._macs[alg] = hmac.new(self._key, digestmod=getattr(hashlib, alg))
+        digest = self._macs[alg].copy()
+        digest.update(body.encode('utf-8'))
+        return digest.hexdigest()
+
+    def _load(self):
+        self.misses += 1
+        param = get_client('ssm').get_parameter(Name=self.name, WithDecryption=True)
+        value = param['Parameter']['Value']
+        self._key = value.encode('ascii')
+        self._macs = {}
+        self._loaded = time.monotonic()
+        self._expires = self._loaded + self.ttl
+
+
+# Use a global to keep it cached across invocations
+_secret = SecretCache('/asanabot/GitHubToken', SECRET_TTL)
+
+# Use a global to keep it cached across invocations; the message handler keeps the
+# persistent record, so this stays in memory and off the webhook's critical path
+_deliveries = IdempotencyCache(DELIVERY_TTL)
+
+
+# Use a global to keep the clients cached across invocations
+_session = None
+_clients = {}
+
+
+def get_client(name):
+    """Get the client for an AWS service, creating it on first use."""
+    global _session
+    if name not in _clients:
+        # Plain botocore: boto3 only adds import time here (it pulls in s3transfer)
+        if _session is None:
+            _session = botocore.session.get_session()
+        _clients[name] = metrics.instrument_client(_session.create_client(name))
+    return _clients[name]
 
 
 class UnauthorizedError(Exception):
-    pass
\ No newline at end of file
+    pass
@@ -0,0 +1,120 @@
+"""Remember what was recently done, so that repeats of it can be skipped.
+
+GitHub redelivers webhooks, SNS delivers at least once and events get
+replayed by hand, so the same work can turn up several times. Keys (a
+delivery id, or an issue with a hash of the state it was synced to) are
+kept in memory for the life of a warm container and, optionally, in a
+persistent tier shared between containers.
+"""
+from collections import OrderedDict
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger('asanabot')
+
+
+class IdempotencyCache:
+    """Values for keys recently acted on, each kept for ``ttl`` seconds.
+
+    Lookups only ever go to memory. A persistent tier (anything with `load`
+    and `save`, like `S3Tier`) is read the first time it's needed and written
+    back by `save`, at most once every ``save_interval`` seconds, so checking
+    for a repeat never makes a request of its own in a warm container, and
+    recording one only does now and then.
+    """
+
+    def __init__(self, ttl, persistent=None, max_entries=5000, save_interval=0):
+        self.ttl = ttl
+        self.persistent = persistent
+        self.max_entries = max_entries
+        self.save_interval = save_interval
+        self._entries = OrderedDict()
+        self._added = {}
+        self._saved = float('-inf')
+        self._loaded = persistent is None
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get the value stored for key, if it hasn't expired."""
+        with self._lock:
+            self._load()
+            expires, value = self._entries.get(key, (0, None))
+            if expires <= time.time():
+                return None
+            return value
+
+    def seen(self, key):
+        return self.get(key) is not None
+
+    def put(self, key, value=True):
+        """Store value for key, for the next ``ttl`` seconds."""
+        with self._lock:
+            self._load()
+            entry = (time.time() + self.ttl, value)
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            self._added[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def save(self, force=False):
+        """Write anything new to the persistent tier, if it's been a while since last time."""
+        with self._lock:
+            if not self._added or self.persistent is None:
+                self._added = {}
+                return
+            # Keys not yet written just wait for the next save
+            if not force and time.monotonic() - self._saved < self.save_interval:
+                return
+            added, self._added = self._added, {}
+            self._saved = time.monotonic()
+        try:
+            self.persistent.save(added, self.max_entries)
+        except Exception as e:
+            logger.info('Unable to save idempotency keys: %s', e)
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            now = time.time()
+            entries = sorted((expires, key, value)
+                             for key, (expires, value) in self.persistent.load().items()
+                             if expires > now)
+            self._entries.update((key, (expires, value)) for expires, key, value in entries)
+        except Exception as e:
+            logger.info('Unable to load idempotency keys: %s', e)
+
+
+class S3Tier:
+    """Keep idempotency keys in a single, compact json object in S3.
+
+    Saving merges with what is there, so that containers working at the same
+    time mostly keep each other's keys; losing one now and then only costs
+    doing that work again.
+    """
+
+    def __init__(self, get_client, bucket, key):
+        self._get_client = get_client
+        self.bucket = bucket
+        self.key = key
+
+    def load(self):
+        client = self._get_client()
+        try:
+            body = client.get_object(Bucket=self.bucket, Key=self.key)['Body'].read()
+        except client.exceptions.NoSuchKey:
+            return {}
+        return json.loads(body)
+
+    def save(self, added, max_entries):
+        now = time.time()
+        entries = {key: entry for key, entry in self.load().items() if entry[0] > now}
+        entries.update(added)
+        # Keep those that will be around longest
+        keep = sorted(entries, key=lambda key: entries[key][0])[-max_entries:]
+        body = json.dumps({key: entries[key] for key in keep}, separators=(',', ':'))
+        self._get_client().put_object(Bucket=self.bucket, Key=self.key, Body=body)
@@ -0,0 +1,156 @@
+"""Count and time the outbound calls made during an invocation.
+
+Everything recorded is emitted at the end of the invocation as a single log
+line in CloudWatch embedded metric format, with a call count, error count,
+retry count and latency histogram for each logical operation.
+"""
+from collections import Counter
+from contextlib import contextmanager
+import functools
+import json
+import threading
+import time
+
+NAMESPACE = 'AsanaBot'
+
+# Limits on metrics per directive, and values per histogram, in embedded metric format
+MAX_METRICS = 100
+MAX_VALUES = 100
+
+
+class Metrics:
+    """Per-invocation counters and latency histograms, keyed by operation name."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget everything; call at the start of an invocation."""
+        with self._lock:
+            self._calls = Counter()
+            self._errors = Counter()
+            self._retries = Counter()
+            self._latency = {}
+
+    def record(self, op, seconds, error=False):
+        """Record one call to op that took seconds."""
+        with self._lock:
+            self._calls[op] += 1
+            if error:
+                self._errors[op] += 1
+            # Whole milliseconds are plenty, and keep the histogram small
+            self._latency.setdefault(op, Counter())[round(seconds * 1000)] += 1
+
+    def retry(self, op):
+        """Record that a call to op is being retried."""
+        with self._lock:
+            self._retries[op] += 1
+
+    @contextmanager
+    def timer(self, op):
+        """Time the calls made inside a with block as one call to op."""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.record(op, time.perf_counter() - start, error=True)
+            raise
+        self.record(op, time.perf_counter() - start)
+
+    def timed(self, op):
+        """Decorate a function so that each call is recorded as op."""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(op):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def instrument_session(self, session, service):
+        """Record every HTTP request made through a requests session.
+
+        Requests are recorded as '<service>.<method>'; responses that the
+        callers will retry (429 and 5xx) are counted as retries.
+        """
+        request = session.request
+
+        def instrumented(method, url, *args, **kwargs):
+            op = '{}.{}'.format(service, method.lower())
+            with self.timer(op):
+                resp = request(method, url, *args, **kwargs)
+            if resp.status_code == 429 or resp.status_code >= 500:
+                self.retry(op)
+            return resp
+
+        session.request = instrumented
+        return session
+
+    def instrument_client(self, client):
+        """Record every call made through a boto3 client as '<service>.<operation>'."""
+        service = client.meta.service_model.service_name
+
+        def before(context, **kwargs):
+            context['metrics_start'] = time.perf_counter()
+
+        def after(http_response, model, context, **kwargs):
+            self.record('{}.{}'.format(service, model.name),
+                        time.perf_counter() - context.get('metrics_start', time.perf_counter()),
+                        error=http_response.status_code >= 400)
+
+        client.meta.events.register('before-call.*.*', before)
+        client.meta.events.register('after-call.*.*', after)
+        return client
+
+    def snapshot(self):
+        """Get the current counts and histograms, by operation."""
+        with self._lock:
+            return {op: {'calls': self._calls[op], 'errors': self._errors[op],
+                         'retries': self._retries[op], 'latency': dict(self._latency[op])}
+                    for op in self._calls}
+
+    def emf(self, function, **properties):
+        """Build the embedded metric format document for what has been recorded."""
+        doc = {'Function': function}
+        doc.update(properties)
+        definitions = []
+        for op, stats in sorted(self.snapshot().items()):
+            for name, unit in (('Calls', 'Count'), ('Errors', 'Count'), ('Retries', 'Count')):
+                key = '{}.{}'.format(op, name)
+                doc[key] = stats[name.lower()]
+                definitions.append({'Name': key, 'Unit': unit})
+            key = '{}.Latency'.format(op)
+            latency = sorted(_coarsen(stats['latency']).items())
+            doc[key] = {'Values': [value for value, _ in latency],
+                        'Counts': [count for _, count in latency]}
+            definitions.append({'Name': key, 'Unit': 'Milliseconds'})
+
+        # Each metric directive can only hold so many metrics
+        doc['_aws'] = {'Timestamp': int(time.time() * 1000),
+                       'CloudWatchMetrics': [{'Namespace': NAMESPACE,
+                                              'Dimensions': [['Function']],
+                                              'Metrics': definitions[i:i + MAX_METRICS]}
+                                             for i in range(0, len(definitions), MAX_METRICS)]}
+        return doc
+
+    def emit(self, function, **properties):
+        """Write the metrics as one log line for CloudWatch to pick up."""
+        # Embedded metrics need to be the whole line, without logging's prefix
+        print(json.dumps(self.emf(function, **properties), separators=(',', ':')), flush=True)
+
+
+def _coarsen(histogram):
+    """Merge histogram buckets until there are few enough values to emit."""
+    step = 1
+    while len(histogram) > MAX_VALUES:
+        step *= 2
+        merged = Counter()
+        for value, count in histogram.items():
+            merged[value // step * step] += count
+        histogram = merged
+    return histogram
+
+
+# Shared by everything running in this container
+metrics = Metrics()
@@ -0,0 +1,46 @@
+"""The compact form of webhook payloads passed from the hook to the message handler.
+
+Only the fields that `sync.IssueInfo` reads are kept, in the same nested
+shape as GitHub's payloads, so both forms can be handled the same way. The
+``schema`` field says which version of this form a payload is in; payloads
+without one are as GitHub sent them.
+"""
+
+SCHEMA_VERSION = 1
+
+# Longest issue body (which becomes the task's notes) to pass along; the rest is
+# only a click away on GitHub
+MAX_BODY_LENGTH = 8000
+
+
+def compact(payload):
+    """Reduce an issues or pull_request event's payload to what gets synced."""
+    kind = 'pull_request' if 'pull_request' in payload else 'issue'
+    nested = payload[kind]
+    body = nested['body'] or ''
+    if len(body) > MAX_BODY_LENGTH:
+        body = body[:MAX_BODY_LENGTH] + '\n\n[Truncated; see GitHub for the rest]'
+    return {'schema': SCHEMA_VERSION,
+            'action': payload['action'],
+            'organization': {'login': payload['organization']['login']},
+            'repository': {'name': payload['repository']['name'],
+                           'milestones_url': payload['repository']['milestones_url']},
+            kind: {'number': nested['number'],
+                   'title': nested['title'],
+                   'state': nested['state'],
+                   'milestone': _user_or_milestone(nested['milestone'], 'number'),
+                   'html_url': nested['html_url'],
+                   'body': body,
+                   'assignee': _user_or_milestone(nested['assignee'], 'login'),
+                   'requested_reviewers': [_user_or_milestone(user, 'login') for user in
+                                           nested.get('requested_reviewers', [])],
+                   'updated_at': nested.get('updated_at')}}
+
+
+def _user_or_milestone(item, key):
+    return None if item is None else {key: item[key], 'url': item.get('url')}
+
+
+def is_supported(payload):
+    """Whether a payload is in a form this code understands."""
+    return payload.get('schema', SCHEMA_VERSION) <= SCHEMA_VERSION
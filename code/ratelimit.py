@@ -0,0 +1,193 @@
+"""Pace requests to each service and retry rate-limited ones within a deadline.
+
+Requests made through an installed session wait for a token from that
+service's bucket. Rate-limited responses (429, or GitHub's 403 with no
+remaining quota) pause the whole service until ``Retry-After`` or the
+reset time has passed, with jitter so that waiting threads don't all retry
+at once. Other failures are retried with jittered exponential backoff. If a
+request can't be made (or retried) before the invocation's deadline,
+`DeadlineExceeded` is raised so that the work can be handed back for retry
+rather than running out the Lambda timeout.
+"""
+from contextlib import contextmanager
+import logging
+import os
+import random
+import threading
+import time
+
+import requests
+
+logger = logging.getLogger('asanabot')
+
+# Seconds to keep in reserve at the end of an invocation for wrapping up
+DEADLINE_MARGIN = 3
+
+# Requests a minute to Asana from one container, counting each action in a batch; the
+# account allows 1500 on paid plans, shared between every function using the token
+ASANA_RATE = float(os.environ.get('ASANA_RATE_LIMIT', 1500)) / 60
+
+# Requests a second to GitHub while plenty of its hourly quota is left
+GITHUB_RATE = 50
+
+# When GitHub says this few requests are left, spread them out until the reset
+GITHUB_LOW_REMAINING = 100
+
+
+class DeadlineExceeded(Exception):
+    """There is not enough time left in the invocation to make a request."""
+
+
+class TokenBucket:
+    """Allow ``rate`` requests a second, in bursts of up to ``burst``."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, deadline, tokens=1):
+        """Wait for tokens, raising `DeadlineExceeded` if that would take too long."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Taking tokens we don't have yet reserves our place in line
+            self._tokens -= tokens
+            start = max(now + max(0, -self._tokens / self.rate), self._paused_until)
+            if start > deadline:
+                self._tokens += tokens
+                raise DeadlineExceeded('Request could not be made in time.')
+        if start > now:
+            time.sleep(start - now)
+
+    def pause(self, seconds):
+        """Hold off all requests for a while."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def set_rate(self, rate, burst):
+        with self._lock:
+            self.rate = max(rate, 0.01)
+            self.burst = burst
+            self._tokens = min(self._tokens, burst)
+
+
+class Scheduler:
+    """Shared pacing and retries for all requests to Asana and GitHub."""
+
+    max_retries = 5
+    backoff = 0.5
+    max_backoff = 30
+
+    def __init__(self):
+        self._buckets = {'asana': TokenBucket(ASANA_RATE, ASANA_RATE * 2),
+                         'github': TokenBucket(GITHUB_RATE, GITHUB_RATE * 2)}
+        self.deadline = float('inf')
+        self._local = threading.local()
+
+    def start(self, context):
+        """Set the deadline for this invocation from the Lambda context (if any)."""
+        if context is None:
+            self.deadline = float('inf')
+        else:
+            remaining = context.get_remaining_time_in_millis() / 1000 - DEADLINE_MARGIN
+            self.deadline = time.monotonic() + remaining
+
+    def remaining(self):
+        """Seconds left before the deadline."""
+        return self.deadline - time.monotonic()
+
+    def check(self):
+        """Raise `DeadlineExceeded` if the deadline has passed."""
+        if self.remaining() <= 0:
+            raise DeadlineExceeded('Out of time for this invocation.')
+
+    @contextmanager
+    def weight(self, tokens):
+        """Count each request this thread makes in the block as ``tokens`` of them.
+
+        Asana counts every action in a batch against the rate limit, so a batch
+        request takes a token for each.
+        """
+        previous = getattr(self._local, 'tokens', 1)
+        self._local.tokens = tokens
+        try:
+            yield
+        finally:
+            self._local.tokens = previous
+
+    def install(self, session, service):
+        """Send all requests from a requests session through the scheduler."""
+        request = session.request
+        bucket = self._buckets[service]
+
+        def scheduled(method, url, *args, **kwargs):
+            for attempt in range(self.max_retries + 1):
+                bucket.acquire(self.deadline, getattr(self._local, 'tokens', 1))
+                try:
+                    resp = request(method, url, *args, **kwargs)
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                    if attempt == self.max_retries:
+                        raise
+                    self._wait(self._backoff(attempt), '{} {}: {}'.format(method, url, e))
+                    continue
+
+                if service == 'github':
+                    self._track_quota(bucket, resp)
+                delay = self._retry_delay(resp, attempt)
+                if delay is None or attempt == self.max_retries:
+                    return resp
+                if resp.status_code in (403, 429):
+                    bucket.pause(delay)
+                self._wait(delay, '{} {}: {}'.format(method, url, resp.status_code))
+            return resp
+
+        session.request = scheduled
+        return session
+
+    def _wait(self, delay, why):
+        if time.monotonic() + delay > self.deadline:
+            raise DeadlineExceeded('No time left to retry {}'.format(why))
+        logger.info('Retrying in %.1fs: %s', delay, why)
+        time.sleep(delay)
+
+    def _backoff(self, attempt):
+        # "Full jitter", so that retries from many threads spread out
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def _retry_delay(self, resp, attempt):
+        """How long to wait before retrying a response, or None if it shouldn't be."""
+        headers = resp.headers
+        limited = resp.status_code == 429 or (resp.status_code == 403
+                                              and headers.get('X-RateLimit-Remaining') == '0')
+        if limited:
+            if 'Retry-After' in headers:
+                delay = float(headers['Retry-After'])
+            elif 'X-RateLimit-Reset' in headers:
+                delay = max(0, float(headers['X-RateLimit-Reset']) - time.time())
+            else:
+                delay = self._backoff(attempt)
+            return delay + random.uniform(0, 1)
+        if resp.status_code >= 500:
+            return self._backoff(attempt)
+        return None
+
+    def _track_quota(self, bucket, resp):
+        """Slow down ahead of time when GitHub says the quota is running low."""
+        remaining = resp.headers.get('X-RateLimit-Remaining')
+        reset = resp.headers.get('X-RateLimit-Reset')
+        if remaining is None or reset is None:
+            return
+        window = max(1, float(reset) - time.time())
+        if int(remaining) < GITHUB_LOW_REMAINING:
+            bucket.set_rate(int(remaining) / window, 1)
+        else:
+            bucket.set_rate(GITHUB_RATE, GITHUB_RATE * 2)
+
+
+# Shared by everything running in this container
+scheduler = Scheduler()
@@ -1,60 +1,272 @@
-import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import lru_cache
 import logging
+import threading
 import xml.etree.ElementTree as ET
 
 import asana
-import boto3
+import urllib.error
 import urllib.request
 
-from sync import get_asana_client
+from metrics import metrics
+from ratelimit import DeadlineExceeded, scheduler
+from sync import (ASANA_BATCH_WINDOW, AsanaBatch, get_asana_client, get_s3, read_object,
+                  write_object)
 
 logger = logging.getLogger('asanabot')
 logger.setLevel(logging.INFO)
 
 xmlns = {'atom': 'http://www.w3.org/2005/Atom'}
-s3 = boto3.resource('s3')
+
+# Seconds to wait on Stack Overflow for each feed
+FEED_TIMEOUT = 20
+
+# How many feeds to fetch at once
+FEED_CONCURRENCY = 8
+
+# How long to remember a question after it falls behind every feed's watermark, in
+# case it's updated again; forgotten ones are found in Asana by their external id
+SEEN_RETENTION = timedelta(days=30)
 
 class Config:
+    """The tags to watch, read from S3 the first time they're needed."""
+
+    key = 'asanabot/stackoverflow_config.json'
+
     def __init__(self):
-        self._obj = s3.Object('unidata-python', 'asanabot/stackoverflow_config.json')
-        self._data = json.loads(self._obj.get()['Body'].read())
+        self._data = None
 
     def __iter__(self):
+        if self._data is None:
+            self._data = read_object(self.key)
         return iter(self._data)
 
     def save(self):
-        self._obj.put(Body=json.dumps(self._data))
+        write_object(self.key, self._data)
 
 
-# Use a global to keep it cached
-config = Config()
+class SeenQuestions:
+    """Index of questions already synced to Asana.
 
+    Each has its task gid, the question's last update, and whether the task
+    was assigned and completed when we last synced it.
+    """
 
-def check_stack_overflow(event, context):
-    asana = AsanaSubmit(get_asana_client())
+    key = 'asanabot/stackoverflow_seen.json'
 
-    for item in config:
-        url = f'https://stackoverflow.com/feeds/tag?tagnames={item["tag"]}&sort=newest'
-        req = urllib.request.Request(url, headers={'User-Agent': 'Asanabot'})
-        xml = urllib.request.urlopen(req)
-        content = xml.read()
-        root = ET.fromstring(content)
-        last_update = item['updated']
-        for question in root.iterfind('atom:entry', xmlns):
-            update_time = question.find('atom:updated', xmlns).text
-            if update_time > last_update:
-                logger.info('Adding task for question: %s',
-                            question.find('atom:title', xmlns).text)
-                asana.submit(question, item)
+    def __init__(self):
+        self._data = None
+        self._dirty = False
+        self._lock = threading.Lock()
 
-        item['updated'] = root.find('atom:updated', xmlns).text
+    @property
+    def data(self):
+        """The index, read from S3 on first use."""
+        # Questions are submitted from many threads; only one should do the reading
+        with self._lock:
+            if self._data is None:
+                try:
+                    self._data = read_object(self.key)
+                except get_s3().exceptions.NoSuchKey:
+                    self._data = {}
+        return self._data
+
+    def get(self, question_id):
+        """Get the task gid, updated time and task state for a question, if we've seen it."""
+        if question_id in self.data:
+            gid, updated, *state = self.data[question_id]
+            known = dict(gid=gid, updated=updated)
+            # Entries written before the state was kept don't have it
+            if state:
+                known['assignee'], known['completed'] = state
+            return known
+        return None
+
+    def add(self, question_id, task, updated):
+        self.data[question_id] = [task['gid'], updated, bool(task.get('assignee')),
+                                  bool(task.get('completed'))]
+        self._dirty = True
+
+    def remove(self, question_id):
+        if self.data.pop(question_id, None):
+            self._dirty = True
+
+    def save(self, since=None):
+        """Write the index back if it changed, first dropping questions not updated after since."""
+        if since is not None and self._data is not None:
+            stale = [question_id for question_id, (_, updated, *_) in self._data.items()
+                     if updated <= since]
+            for question_id in stale:
+                del self._data[question_id]
+            self._dirty = self._dirty or bool(stale)
+        if self._dirty:
+            write_object(self.key, self.data, sort_keys=True, separators=(',', ':'))
+            self._dirty = False
+
+
+# Use a global to keep it cached; nothing is read until first use
+config = Config()
+seen = SeenQuestions()
 
-    config.save()
+
+def check_stack_overflow(event, context):
+    metrics.reset()
+    scheduler.start(context)
+    try:
+        _check_stack_overflow()
+    finally:
+        metrics.emit('StackOverflowChecker')
+
+
+def _check_stack_overflow():
+    client = get_asana_client()
+
+    items = list(config)
+    previous = {id(item): dict(item) for item in items}
+    with ThreadPoolExecutor(max_workers=max(1, min(len(items), FEED_CONCURRENCY))) as executor:
+        feeds = list(executor.map(fetch_feed, items))
+
+    new_questions = []
+    updated_items = []
+    for item, feed in zip(items, feeds):
+        if feed is None:
+            continue
+        updated, questions = feed
+        if questions:
+            updated_items.append(item)
+        for question in questions:
+            logger.info('Adding task for question: %s',
+                        question.find('atom:title', xmlns).text)
+            new_questions.append((question, item))
+
+        if updated:
+            item['updated'] = updated
+
+    # Submit together so that the task requests can share batches; look up
+    # the shared workspace, tag, projects, owners and index of seen questions
+    # first so the threads don't all go looking.
+    batch = AsanaBatch(client, window=ASANA_BATCH_WINDOW,
+                       parties=min(AsanaBatch.max_actions, len(new_questions)))
+    asana = AsanaSubmit(client, batch=batch)
+    if new_questions:
+        asana.stackoverflow_tag
+        seen.data
+    for item in updated_items:
+        asana.find_project(asana.unidata, item['project'])
+        asana.find_asana_user(asana.unidata, item['owner'])
+    with ThreadPoolExecutor(max_workers=AsanaBatch.max_actions) as executor:
+        futures = [executor.submit(asana.submit, question, item)
+                   for question, item in new_questions]
+
+    # Questions we ran out of time (or rate limit) for are picked up next run by
+    # leaving their feed's watermark (and ETag) where it was.
+    for future, (question, item) in zip(futures, new_questions):
+        if future.exception() is not None:
+            logger.warning('Leaving %s for next time: %s', question_to_id(question),
+                           future.exception())
+            # Put it back as it was, which means without validators it didn't have before
+            item.clear()
+            item.update(previous[id(item)])
+
+    # Nothing to record if every feed was unchanged
+    if any(feed is not None for feed in feeds):
+        config.save()
+    seen.save(retention_cutoff(items))
+
+
+def retention_cutoff(items):
+    """Get the time before which seen questions can be forgotten.
+
+    Feeds only return questions updated after their watermark, so a question
+    not updated since well before the lowest of them is unlikely to turn up.
+    """
+    if not items:
+        return None
+    lowest = datetime.fromisoformat(min(item['updated'] for item in items))
+    return (lowest - SEEN_RETENTION).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+@metrics.timed('feed_fetch')
+def fetch_feed(item):
+    """Fetch the feed for a config item and read the questions updated since last time.
+
+    The request is conditional on the feed's stored ETag/Last-Modified, which
+    are updated in item. Returns the feed's updated time and the new entries,
+    or None if the feed is unchanged or can't be had.
+    """
+    url = f'https://stackoverflow.com/feeds/tag?tagnames={item["tag"]}&sort=newest'
+    headers = {'User-Agent': 'Asanabot'}
+    if item.get('etag'):
+        headers['If-None-Match'] = item['etag']
+    if item.get('last_modified'):
+        headers['If-Modified-Since'] = item['last_modified']
+
+    req = urllib.request.Request(url, headers=headers)
+    try:
+        with urllib.request.urlopen(req, timeout=FEED_TIMEOUT) as xml:
+            feed = read_feed(xml, item['updated'])
+            etag = xml.headers.get('ETag')
+            last_modified = xml.headers.get('Last-Modified')
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            logger.debug('Feed for %s unchanged.', item['tag'])
+        else:
+            logger.exception('Error fetching feed for %s:', item['tag'], exc_info=e)
+        return None
+    except Exception as e:
+        logger.exception('Error fetching feed for %s:', item['tag'], exc_info=e)
+        return None
+
+    item['etag'] = etag
+    item['last_modified'] = last_modified
+    return feed
+
+
+def read_feed(stream, since):
+    """Read a feed's updated time and the entries updated after since.
+
+    The feed is parsed as it streams in. Entries come newest first, so reading
+    stops at the first one not updated after since and the rest of the feed is
+    never downloaded. Finished elements are detached from the tree, so only
+    the new entries are kept around.
+    """
+    updated = None
+    entries = []
+    root = None
+    depth = 0
+    for event, elem in ET.iterparse(stream, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+
+        depth -= 1
+        if depth != 1:
+            continue
+
+        # A direct child of the feed is complete
+        root.remove(elem)
+        if elem.tag == atom_tag('updated'):
+            updated = elem.text
+        elif elem.tag == atom_tag('entry'):
+            if elem.find('atom:updated', xmlns).text <= since:
+                break
+            entries.append(elem)
+
+    return updated, entries
+
+
+def atom_tag(name):
+    """Get the fully-qualified tag for an element in the atom namespace."""
+    return f'{{{xmlns["atom"]}}}{name}'
 
 
 class AsanaSubmit:
-    def __init__(self, client):
+    def __init__(self, client, batch=None):
         self._client = client
+        self._batch = AsanaBatch(client) if batch is None else batch
         self._unidata_gid = None
         self._tag_gid = None
 
@@ -81,11 +293,13 @@ class AsanaSubmit:
                     self._tag_gid = tag['gid']
                     break
             else:  # Did not find one
-                tag = self._client.tags.create_in_workspace(workspace, dict(name=tag_name))
+                tag = self._client.tags.create_in_workspace(self.unidata, dict(name=tag_name))
                 self._tag_gid = tag['gid']
 
         return self._tag_gid
 
+    @lru_cache()
+    @metrics.timed('find_project')
     def find_project(self, workspace: int, name: str):
         """Find a project by name."""
         for project in self._client.projects.find_all({'workspace': workspace}):
@@ -93,6 +307,8 @@ class AsanaSubmit:
                 return project
         raise ValueError(f'Could not find appropriate project for: {name}')
 
+    @lru_cache()
+    @metrics.timed('find_asana_user')
     def find_asana_user(self, workspace: int, name: str):
         """Find an asana user by name."""
         for user in self._client.users.find_by_workspace(workspace):
@@ -100,11 +316,19 @@ class AsanaSubmit:
                 return user
         return 'null'
 
+    @metrics.timed('submit')
     def submit(self, question, config):
         """Synchronize a GitHub issue to an Asana task.
 
         Either create a new task or update attributes of existing task.
         """
+        question_id = question_to_id(question)
+        updated = question.find('atom:updated', xmlns).text
+        known = seen.get(question_id)
+        if known and known['updated'] >= updated:
+            logger.debug('Already synced %s, skipping.', question_id)
+            return
+
         project = self.find_project(self.unidata, config['project'])
         logger.debug('Got project for %s: %s', config['project'], project)
         project = project['gid']
@@ -115,14 +339,21 @@ class AsanaSubmit:
 
         logger.debug('Syncing attributes: %s', str(sync_attrs))
 
-        try:
-            return self.create_task(self.unidata, project, question, sync_attrs)
-        except asana.error.InvalidRequestError as e:  # Already exists
-            logger.debug('Error from creating task: %s', e)
+        if not known:
+            try:
+                task = self.create_task(self.unidata, project, question, sync_attrs)
+                seen.add(question_id, task, updated)
+                return task
+            except asana.error.InvalidRequestError as e:  # Already exists
+                logger.debug('Error from creating task: %s', e)
 
-        # Ok, it already exists or an error occurred. Try syncing...
+        # Ok, it already exists or an error occurred. Try syncing, going by the
+        # task as we left it if we know that.
         try:
-            task = self.find_task(question)
+            if known and 'assignee' in known:
+                task = known
+            else:
+                task = self.find_task(question, known['gid'] if known else None)
             task_id = task['gid']
             logger.debug('Found task: %s', task_id)
 
@@ -131,19 +362,26 @@ class AsanaSubmit:
             if task['assignee'] and not task['completed']:
                 sync_attrs.pop('assignee', None)
 
-            return self._client.tasks.update(task_id, sync_attrs)
-        except ValueError as e:
+            task = self._batch.update_task(task_id, sync_attrs)
+            seen.add(question_id, task, updated)
+            return task
+        except (ValueError, asana.error.NotFoundError) as e:
+            # Forget about it so that it is created anew next time
+            seen.remove(question_id)
             # Only an error in the event that it meets the criteria for creation
             logger.exception('Somehow could not find task for %s event though'
                              ' we think we had a duplicate.', question_to_id(question),
                              exc_info=e)
+        except (DeadlineExceeded, asana.error.RateLimitEnforcedError):
+            raise
         except Exception as e:
             logger.exception('Something else went wrong.', exc_info=e)
 
-    def find_task(self, question):
-        """Find task corresponding to the issue."""
+    def find_task(self, question, gid=None):
+        """Find task corresponding to the issue, directly by gid if we know it."""
+        task = gid if gid else 'external:' + question_to_id(question)
         try:
-            return self._client.tasks.find_by_id('external:' + question_to_id(question))
+            return self._batch.find_task(task)
         except asana.error.NotFoundError as e:
             raise ValueError('No task found for issue.') from e
 
@@ -157,7 +395,7 @@ class AsanaSubmit:
                   'projects': [project],
                   'tags': [self.stackoverflow_tag]}
         params.update(attrs)
-        return self._client.tasks.create_in_workspace(workspace, params)
+        return self._batch.create_task(workspace, params)
 
 def question_to_id(question):
     """Create a unique gid from a question."""
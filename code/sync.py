@@ -1,80 +1,421 @@
 from collections import namedtuple
-from functools import lru_cache
+from concurrent.futures import Future, ThreadPoolExecutor
+import hashlib
 import json
 import logging
 import os
+import threading
+import time
 
 import asana
-import boto3
+import botocore.session
 import requests
 
+from idempotency import IdempotencyCache, S3Tier
+from metrics import metrics
+from payload import is_supported
+from ratelimit import DeadlineExceeded, scheduler
+
 logger = logging.getLogger('asanabot')
 logger.setLevel(logging.DEBUG)
 
-s3 = boto3.resource('s3')
+# How long, in seconds, directory lookups (workspaces, projects, users...) stay valid
+DIRECTORY_TTL = float(os.environ.get('DIRECTORY_TTL', 3600))
+
+# Where in the bucket to keep a snapshot of the directory for cold starts; empty disables
+DIRECTORY_SNAPSHOT = os.environ.get('DIRECTORY_SNAPSHOT', 'asanabot/directory_cache.json')
+
+# How long, in seconds, to trust what we last saw of a task rather than looking it up again
+TASK_CACHE_TTL = float(os.environ.get('TASK_CACHE_TTL', 900))
+
+# How many SNS records to sync at once; records for the same issue still run in order
+SYNC_CONCURRENCY = int(os.environ.get('SYNC_CONCURRENCY', 4))
+
+# How long, in seconds, to trust GitHub lookups (user names, milestones) before revalidating
+GITHUB_CACHE_TTL = float(os.environ.get('GITHUB_CACHE_TTL', 3600))
+
+GITHUB_API_HEADERS = {'Accept': 'application/vnd.github.machine-man-preview+json'}
+
+# With a token, GitHub allows 5000 API requests an hour rather than 60; reconciling needs them
+if os.environ.get('GITHUB_TOKEN'):
+    GITHUB_API_HEADERS['Authorization'] = 'token ' + os.environ['GITHUB_TOKEN']
+
+# SSM parameter to get the GitHub token from instead, when it is first needed
+GITHUB_TOKEN_PARAMETER = os.environ.get('GITHUB_TOKEN_PARAMETER', '')
+
+# How long, in seconds, to wait for more task requests before sending a partial batch
+ASANA_BATCH_WINDOW = float(os.environ.get('ASANA_BATCH_WINDOW', 0.05))
+
+# How long, in seconds, to remember deliveries, and the state issues were synced to, so
+# that repeats can be skipped
+IDEMPOTENCY_TTL = float(os.environ.get('IDEMPOTENCY_TTL', 86400))
+
+# Where in the bucket to share those between containers; empty keeps them in memory only
+IDEMPOTENCY_KEY = os.environ.get('IDEMPOTENCY_KEY', 'asanabot/idempotency.json')
+
+# How often, in seconds, a container writes what it has recorded there
+IDEMPOTENCY_SAVE_INTERVAL = float(os.environ.get('IDEMPOTENCY_SAVE_INTERVAL', 60))
 
 def process_payload(event, context):
     """Take the in-bound message and feed to syncing code."""
+    metrics.reset()
+    scheduler.start(context)
+
+    logger.debug('Event: %s', event)
+    messages = []
+    for record in event['Records']:
+        if record['EventSource'] == 'aws:sns':
+            logger.info('Received: %s', record['Sns']['MessageId'])
+            attributes = record['Sns'].get('MessageAttributes') or {}
+            delivery = attributes.get('GitHubDelivery', {}).get('Value')
+            messages.append((record['Sns']['MessageId'], record['Sns']['Message'], delivery))
+
+    try:
+        failed = sync_deliveries(messages)
+    finally:
+        metrics.emit('messagehandler', Messages=len(messages))
+    if failed:
+        # Let SNS retry the delivery
+        raise RuntimeError('Failed to sync messages: {}'.format(', '.join(failed)))
+
+
+def process_queue(event, context):
+    """Sync a batch of messages from the queue, reporting those that failed.
+
+    The queue hands over many messages at once, so the Asana client and the
+    caches are shared by all of them. Only the messages that failed are put
+    back on the queue to be retried.
+    """
+    metrics.reset()
+    scheduler.start(context)
+
+    logger.debug('Event: %s', event)
+    messages = []
+    for record in event['Records']:
+        if record['eventSource'] == 'aws:sqs':
+            logger.info('Received: %s', record['messageId'])
+            messages.append(queue_message(record))
+
+    try:
+        failed = sync_deliveries(messages)
+    finally:
+        metrics.emit('messagehandler', Messages=len(messages))
+    return {'batchItemFailures': [{'itemIdentifier': msg_id} for msg_id in failed]}
+
+
+def queue_message(record):
+    """Get the (id, body, delivery id) for a message from the queue.
+
+    Unless the topic's subscription uses raw message delivery, the message
+    comes wrapped in an SNS notification, along with its attributes.
+    """
+    body = record['body']
+    attributes = record.get('messageAttributes') or {}
+    delivery = attributes.get('GitHubDelivery', {}).get('stringValue')
+    try:
+        envelope = json.loads(body)
+    except ValueError:
+        envelope = {}
+    if isinstance(envelope, dict) and envelope.get('Type') == 'Notification':
+        body = envelope['Message']
+        attributes = envelope.get('MessageAttributes') or {}
+        delivery = attributes.get('GitHubDelivery', {}).get('Value')
+    return record['messageId'], body, delivery
+
+
+def sync_deliveries(messages):
+    """Sync (id, body, delivery id) messages, returning the ids of those that failed.
+
+    Deliveries that have already been synced are dropped before anything
+    else is done for them.
+    """
+    fresh = []
+    for msg_id, message, delivery in messages:
+        if delivery and synced.seen('delivery:' + delivery):
+            logger.info('Skipping %s: delivery %s was already synced.', msg_id, delivery)
+        else:
+            fresh.append((msg_id, message, delivery))
+    if not fresh:
+        return []
+
     try:
         asana_client = get_asana_client()
     except Exception as e:
         logger.exception('Error initializing Asana client:', exc_info=e)
         raise
 
+    failed = sync_messages(asana_client, [(msg_id, message) for msg_id, message, _ in fresh])
+    for msg_id, _, delivery in fresh:
+        if delivery and msg_id not in failed:
+            synced.put('delivery:' + delivery)
+    directory.save()
+    synced.save()
+    return failed
+
+def sync_messages(asana_client, messages, concurrency=SYNC_CONCURRENCY):
+    """Sync (id, body) message pairs to Asana, returning the ids of those that failed.
+
+    Messages are grouped by the issue they refer to; up to ``concurrency``
+    groups are worked on at once, while the messages within a group are
+    handled in order.
+    """
+    groups = {}
+    failed = []
+    for msg_id, message in messages:
+        try:
+            body = json.loads(message)
+        except ValueError:
+            logger.info('Message %s is not json: %s', msg_id, message[:100])
+            continue
+        if isinstance(body, dict) and not is_supported(body):
+            # Sent by a newer hook; leave it to be retried once we're updated too
+            logger.error('Message %s has unknown schema %s', msg_id, body['schema'])
+            failed.append(msg_id)
+            continue
+        try:
+            key = payload_to_id(body)
+        except (KeyError, TypeError):
+            # Not an issue event; it will be turned away when handled
+            key = msg_id
+        groups.setdefault(key, []).append((msg_id, body))
+
+    workers = max(1, min(concurrency, len(groups)))
+    batch = AsanaBatch(asana_client, window=ASANA_BATCH_WINDOW, parties=workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for group_failed in executor.map(lambda group: _sync_group(asana_client, group, batch),
+                                         groups.values()):
+            failed.extend(group_failed)
+    return failed
+
+def _sync_group(asana_client, group, batch=None):
+    """Sync the messages for a single issue, returning the ids that failed.
+
+    All of the events are collapsed into a single update of the final state.
+    """
+    issues = []
+    ids = []
+    for msg_id, body in group:
+        try:
+            issue = IssueInfo.from_json(body, api_headers=GITHUB_API_HEADERS)
+            logger.debug('Handling issue: %s', issue)
+            issues.append(issue)
+            ids.append(msg_id)
+        except ValueError as e:
+            logger.info('Unhandled json event type: %s', json.dumps(body)[:100])
+            logger.info('Not an event for me. ({})'.format(e))
+        except DeadlineExceeded as e:
+            logger.warning('Handing back %s for retry: %s', msg_id, e)
+            return [msg_id for msg_id, _ in group]
+        except Exception as e:
+            logger.exception('Exception handling %s:', msg_id, exc_info=e)
+            return [msg_id for msg_id, _ in group]
+
+    if not issues:
+        return []
+
     try:
-        logger.debug('Event: %s', event)
-        for record in event['Records']:
-            if record['EventSource'] == 'aws:sns':
-                logger.info('Received: %s', record['Sns']['MessageId'])
-                body = json.loads(record['Sns']['Message'])
-                headers = {'Accept': 'application/vnd.github.machine-man-preview+json'}
-                issue = IssueInfo.from_json(body, api_headers=headers)
-                logger.debug('Handling issue: %s', issue)
-                syncer = AsanaSync(asana_client)
-                syncer.sync_issue(issue)
-    except ValueError as e:
-        logger.info('Unhandled json event type: %s', json.dumps(body)[:100])
-        logger.info('Not an event for me. ({})'.format(e))
+        scheduler.check()
+        issue, create_new = coalesce_issues(issues)
+        if len(issues) > 1:
+            logger.info('Coalesced %d events for %s', len(issues), issue_to_id(issue))
+
+        # Replays, and repeats without a delivery id, would leave the task as it is
+        key = 'issue:' + issue_to_id(issue)
+        state = desired_state(issue, create_new)
+        if state is not None and synced.get(key) == state:
+            logger.info('Already synced %s to this state, skipping.', issue_to_id(issue))
+            return []
+
+        syncer = AsanaSync(asana_client, batch=batch)
+        syncer.sync_issue(issue, create_new=create_new)
+        if state is not None:
+            synced.put(key, state)
+    except DeadlineExceeded as e:
+        logger.warning('Handing back %s for retry: %s', ', '.join(ids), e)
+        return ids
     except Exception as e:
-        logger.exception('Exception:', exc_info=e)
-        raise e
+        logger.exception('Exception syncing %s:', ', '.join(ids), exc_info=e)
+        return ids
+    return []
+
+def reconcile_repos(event, context):
+    """Bring Asana in line with all of the issues in some repositories.
+
+    The event gives the GitHub 'organization' and the 'repositories' in it to check.
+    """
+    metrics.reset()
+    scheduler.start(context)
+    totals = [0, 0, 0]
+    try:
+        load_github_token()
+        asana_client = get_asana_client()
+        batch = AsanaBatch(asana_client, window=ASANA_BATCH_WINDOW)
+        syncer = AsanaSync(asana_client, batch=batch)
+        org = event['organization']
+        for repo in event['repositories']:
+            counts = syncer.reconcile(org, repo, list_issues(org, repo))
+            logger.info('Reconciled %s/%s: %d created, %d updated, %d failed', org, repo, *counts)
+            totals = [total + count for total, count in zip(totals, counts)]
+        directory.save()
+    finally:
+        metrics.emit('reconciler', Created=totals[0], Updated=totals[1], Failed=totals[2])
+    if totals[2]:
+        raise RuntimeError('Failed to reconcile {} tasks'.format(totals[2]))
+
+def load_github_token():
+    """Authenticate GitHub requests with the token from SSM, if there is one to get."""
+    if 'Authorization' in GITHUB_API_HEADERS or not GITHUB_TOKEN_PARAMETER:
+        return
+    ssm = metrics.instrument_client(botocore.session.get_session().create_client('ssm'))
+    try:
+        param = ssm.get_parameter(Name=GITHUB_TOKEN_PARAMETER, WithDecryption=True)
+    except ssm.exceptions.ParameterNotFound:
+        logger.warning('No GitHub token in %s; GitHub allows only 60 requests an hour without.',
+                       GITHUB_TOKEN_PARAMETER)
+        return
+    GITHUB_API_HEADERS['Authorization'] = 'token ' + param['Parameter']['Value']
+
+# Use a global to keep the client, and its connection pool, across invocations
+_asana_client = None
 
+@metrics.timed('get_asana_client')
 def get_asana_client():
-    """Handle the details of setting up OAUTH2 access to Asana."""
-    creds_obj = s3.Object('unidata-python', 'asanabot/asana_client')
-    creds = json.loads(creds_obj.get()['Body'].read())
+    """Handle the details of setting up OAUTH2 access to Asana.
+
+    The client is created once per container and reused while its token is
+    valid; expired tokens are refreshed in place by the OAuth session.
+    """
+    global _asana_client
+    if _asana_client is None:
+        _asana_client = _create_asana_client()
+    return _asana_client
+
+# Use a global to keep the client cached across invocations
+_s3 = None
+
+def get_s3():
+    """Get the S3 client, creating it on first use."""
+    global _s3
+    if _s3 is None:
+        # Plain botocore: boto3 only adds import time here (it pulls in s3transfer)
+        _s3 = metrics.instrument_client(botocore.session.get_session().create_client('s3'))
+    return _s3
+
+def read_object(key):
+    """Read a json document from our bucket."""
+    return json.loads(get_s3().get_object(Bucket='unidata-python', Key=key)['Body'].read())
+
+def write_object(key, data, **kwargs):
+    """Write data to our bucket as a json document."""
+    get_s3().put_object(Bucket='unidata-python', Key=key, Body=json.dumps(data, **kwargs))
+
+# Use a global to keep it cached across invocations
+synced = IdempotencyCache(IDEMPOTENCY_TTL,
+                          S3Tier(get_s3, 'unidata-python', IDEMPOTENCY_KEY) if IDEMPOTENCY_KEY
+                          else None, save_interval=IDEMPOTENCY_SAVE_INTERVAL)
+
+def _create_asana_client():
+    creds = read_object('asanabot/asana_client')
 
     ASANA_CLIENT_ID = creds['ASANA_CLIENT_ID']
     ASANA_SECRET_ID = creds['ASANA_CLIENT_SECRET']
     token_key = 'asanabot/asana_token'
 
-    def save_token(token):
-        token_obj = s3.Object('unidata-python', token_key)
-        token_obj.put(Body=json.dumps(token))
+    def load_token():
+        return read_object(token_key)
 
-    token_obj = s3.Object('unidata-python', token_key)
-    token = json.loads(token_obj.get()['Body'].read())
+    def save_token(token):
+        # The session already holds the new token in memory; just persist it
+        # for other containers.
+        write_object(token_key, token)
 
-    client = asana.Client.oauth(client_id=ASANA_CLIENT_ID, client_secret=ASANA_SECRET_ID, token=token,
+    client = asana.Client.oauth(client_id=ASANA_CLIENT_ID, client_secret=ASANA_SECRET_ID, token=load_token(),
                                 auto_refresh_url='https://app.asana.com/-/oauth_token',
                                 auto_refresh_kwargs={'client_id': ASANA_CLIENT_ID, 'client_secret': ASANA_SECRET_ID},
                                 token_updater=save_token, redirect_uri='urn:ietf:wg:oauth:2.0:oob')
     client.headers={'asana-enable': 'string_ids,new_sections,new_user_task_lists,new_project_templates'}
     client.headers={'asana-disable': 'new_goal_memberships'}
+
+    # If refreshing fails, another container may have already refreshed and
+    # saved a new token, so only then go back to S3 for it.
+    refresh_token = client.session.refresh_token
+
+    def refresh_or_reload(*args, **kwargs):
+        try:
+            return refresh_token(*args, **kwargs)
+        except Exception as e:
+            token = load_token()
+            if token == client.session.token:
+                raise
+            logger.info('Refreshing Asana token failed (%s), using token from S3.', e)
+            client.session.token = token
+            return token
+
+    client.session.refresh_token = refresh_or_reload
+    metrics.instrument_session(client.session, 'asana')
+
+    # Retries (and rate limits) are handled by the scheduler
+    scheduler.install(client.session, 'asana')
+    client.options['max_retries'] = 0
     return client
 
+class GitHubCache:
+    """Cache GETs from the GitHub API on a shared, keep-alive session.
+
+    Entries are trusted for ``ttl`` seconds, after which they are revalidated
+    with their ETag; unchanged data then comes back as a 304, which does not
+    count against the rate limit. Only what ``extract`` pulls out of the
+    response is kept.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.session = scheduler.install(metrics.instrument_session(requests.Session(), 'github'),
+                                         'github')
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, url, headers={}, extract=lambda data: data):
+        """Get (extracted) json from url, using the cache where possible."""
+        with self._lock:
+            entry = self._entries.get(url)
+        if entry and time.monotonic() < entry['expires']:
+            return entry['value']
+
+        req_headers = dict(headers)
+        if entry and entry['etag']:
+            req_headers['If-None-Match'] = entry['etag']
+        resp = self.session.get(url, headers=req_headers)
+        if resp.status_code == 304:
+            logger.debug('Not modified: %s', url)
+            value = entry['value']
+        else:
+            # An error isn't what was asked for; let it fail the message, to be retried
+            resp.raise_for_status()
+            value = extract(resp.json())
+
+        with self._lock:
+            self._entries[url] = dict(expires=time.monotonic() + self.ttl, value=value,
+                                      etag=resp.headers.get('ETag'))
+        return value
+
+
+# Use a global to keep it cached across invocations
+github = GitHubCache(GITHUB_CACHE_TTL)
+
+
 _IssueInfo = namedtuple('IssueInfo', ['number', 'organization', 'repository',
                                       'title', 'state', 'action', 'milestoned', 'assignee',
-                                      'is_pr', 'html_url', 'body', 'repo_has_milestones'])
+                                      'is_pr', 'html_url', 'body', 'milestones_url',
+                                      'updated_at'])
 class IssueInfo(_IssueInfo):
     @classmethod
-    def from_json(cls, json: dict, api_headers={}):
+    def from_json(cls, json: dict, api_headers=GITHUB_API_HEADERS):
         try:
             fields = {}
             fields['organization'] = json['organization']['login']
             fields['repository'] = json['repository']['name']
-            fields['repo_has_milestones'] = cls._check_for_milestones(json['repository'],
-                                                                      api_headers)
+            fields['milestones_url'] = json['repository']['milestones_url'].rsplit('{', maxsplit=1)[0]
             fields['action'] = json['action']
             fields['is_pr'] = 'pull_request' in json
             nested = json['pull_request'] if fields['is_pr'] else json['issue']
@@ -83,7 +424,10 @@ class IssueInfo(_IssueInfo):
             fields['state'] = nested['state']
             fields['milestoned'] = bool(nested['milestone'])
             fields['html_url'] = nested['html_url']
-            fields['body'] = nested['body']
+            # GitHub gives no body at all for an issue without a description
+            fields['body'] = nested['body'] or ''
+            # Not in payloads compacted before it was kept
+            fields['updated_at'] = nested.get('updated_at')
             if nested['assignee']:
                 fields['assignee'] = cls._get_user_name(nested['assignee'], api_headers)
             elif nested.get('requested_reviewers'):
@@ -98,72 +442,371 @@ class IssueInfo(_IssueInfo):
             logger.debug('Event missing something: %s', e)
             raise ValueError('Improper event json')
 
+    @property
+    def repo_has_milestones(self):
+        """Whether the repository uses milestones; only looked up when asked for."""
+        return self._check_for_milestones(self.milestones_url, GITHUB_API_HEADERS)
+
     @staticmethod
-    def _check_for_milestones(repo_json, headers={}):
-        url = repo_json['milestones_url'].rsplit('{', maxsplit=1)[0]
-        resp = requests.get(url, headers=headers)
-        return bool(resp.json())
+    @metrics.timed('_check_for_milestones')
+    def _check_for_milestones(url, headers={}):
+        return github.get(url, headers=headers, extract=bool)
 
     @staticmethod
+    @metrics.timed('_get_user_name')
     def _get_user_name(user_json, headers={}):
-        resp = requests.get(user_json['url'], headers=headers)
-        return resp.json()['name']
+        return github.get(user_json['url'], headers=headers, extract=lambda user: user['name'])
+
+def list_issues(org, repo):
+    """Get all of a repository's issues and pull requests, a page at a time."""
+    url = 'https://api.github.com/repos/{}/{}/issues'.format(org, repo)
+    params = {'state': 'all', 'per_page': 100}
+    repository = {'name': repo,
+                  'milestones_url': url.rsplit('/', maxsplit=1)[0] + '/milestones{/number}'}
+    issues = []
+    while url:
+        resp = github.session.get(url, params=params, headers=GITHUB_API_HEADERS)
+        resp.raise_for_status()
+        for nested in resp.json():
+            # The listing has all we sync of a pull request too, so stands in for it
+            payload = {'action': 'reconcile', 'organization': {'login': org},
+                       'repository': repository,
+                       'pull_request' if 'pull_request' in nested else 'issue': nested}
+            issues.append(IssueInfo.from_json(payload))
+        # The link to the next page carries the parameters
+        url = resp.links.get('next', {}).get('url')
+        params = None
+    return issues
+
+class AsanaBatch:
+    """Send single-task requests to Asana together using the batch API.
+
+    Requests can come from many threads; each caller blocks until the result
+    of its own action comes back (or its error is raised, as the same asana
+    error the regular client would raise). A batch is sent as soon as
+    `max_actions` are waiting, or as soon as all of the ``parties`` (the
+    threads that might make requests) are waiting, or otherwise ``window``
+    seconds after the first one. With no window, each request is sent right away.
+    """
+
+    max_actions = 10
+
+    def __init__(self, client, window=0, parties=max_actions):
+        self._client = client
+        self.window = window
+        self.parties = max(1, min(parties, self.max_actions))
+        self._lock = threading.Lock()
+        self._pending = []
+        self._timer = None
+
+    @metrics.timed('create_task')
+    def create_task(self, workspace, params):
+        """Create a task in a workspace."""
+        return self.request('post', '/workspaces/{}/tasks'.format(workspace), data=params)
+
+    @metrics.timed('find_task')
+    def find_task(self, task, params=None):
+        """Get a task, by gid or by 'external:' id."""
+        return self.request('get', '/tasks/{}'.format(task), options=params)
+
+    @metrics.timed('update')
+    def update_task(self, task, params):
+        """Update fields of a task."""
+        return self.request('put', '/tasks/{}'.format(task), data=params)
+
+    def request(self, method, path, data=None, options=None):
+        """Queue an action for the next batch and wait for its result."""
+        future = Future()
+        with self._lock:
+            self._pending.append((dict(method=method, relative_path=path, data=data,
+                                       options=options), future))
+            if self.window <= 0 or len(self._pending) >= self.parties:
+                actions = self._take()
+            else:
+                actions = None
+                if self._timer is None:
+                    self._timer = threading.Timer(self.window, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+
+        if actions:
+            self._send(actions)
+        return future.result()
+
+    def flush(self):
+        """Send any waiting actions now."""
+        with self._lock:
+            actions = self._take()
+        if actions:
+            self._send(actions)
+
+    def _take(self):
+        actions = self._pending[:self.max_actions]
+        self._pending = self._pending[self.max_actions:]
+        if self._timer is not None and not self._pending:
+            self._timer.cancel()
+            self._timer = None
+        return actions
+
+    def _send(self, actions):
+        if len(actions) == 1:
+            # Not worth a batch; make the plain request
+            action, future = actions[0]
+            try:
+                future.set_result(self._direct(**action))
+            except Exception as e:
+                future.set_exception(e)
+            return
+
+        logger.debug('Sending batch of %d actions.', len(actions))
+        try:
+            body = [{k: v for k, v in action.items() if v is not None} for action, _ in actions]
+            with metrics.timer('batch'), scheduler.weight(len(actions)):
+                results = self._client.batch_api.create_batch_request({'actions': body})
+        except Exception as e:
+            for _, future in actions:
+                future.set_exception(e)
+            return
+
+        try:
+            for (_, future), result in zip(actions, results):
+                if result['status_code'] < 400:
+                    future.set_result(result['body']['data'])
+                else:
+                    future.set_exception(_batch_error(result))
+        finally:
+            # Whatever went wrong above, nobody should be left waiting
+            for _, future in actions:
+                if not future.done():
+                    future.set_exception(asana.error.AsanaError('No result in batch response'))
+
+    def _direct(self, method, relative_path, data, options):
+        if method == 'get':
+            return self._client.get(relative_path, options or {})
+        return getattr(self._client, method)(relative_path, data or {}, **(options or {}))
+
+
+def _batch_error(result):
+    """Make the error for a failed action in a batch, as the client would raise it."""
+    response = _BatchResponse(result)
+    error = asana.client.STATUS_MAP.get(response.status)
+    if error is not None:
+        try:
+            return error(response)
+        except Exception:
+            # Some errors expect more than a batch result has, like a Retry-After header
+            pass
+    return asana.error.AsanaError('Batch action failed', response.status, response)
+
+
+class _BatchResponse:
+    """Look enough like a response for asana's error classes."""
+
+    def __init__(self, result):
+        self.status = self.status_code = result['status_code']
+        self.headers = result.get('headers') or {}
+        self._body = result.get('body') or {}
+
+    def json(self):
+        return self._body
+
+
+class Directory:
+    """Name to record lookups for Asana objects.
+
+    Each table (workspaces, projects in a workspace, ...) is filled with a single
+    pass through the listing from Asana and kept until it is older than ``ttl``.
+    This lives at module scope, so it is shared by all records and by warm
+    invocations; it can also be snapshotted to S3 to help cold starts.
+    """
+
+    # Don't re-list a table because of a missing name more often than this
+    min_refresh = 60
+
+    def __init__(self, ttl, snapshot_key=None):
+        self.ttl = ttl
+        self.snapshot_key = snapshot_key
+        self._tables = {}
+        self._dirty = False
+        self._snapshot_loaded = False
+        # Records are synced from several threads; only one should list a table
+        self._lock = threading.RLock()
+
+    def lookup(self, table, name, fetch):
+        """Find the record for name in table, using fetch to list the table if needed.
+
+        Returns None if the name cannot be found.
+        """
+        with self._lock:
+            self._load_snapshot()
+            entries = self._table(table, fetch)
+            if name not in entries:
+                loaded, _ = self._tables[table]
+                if time.time() - loaded >= self.min_refresh:
+                    logger.debug('%s missing from %s, refreshing.', name, table)
+                    entries = self._table(table, fetch, refresh=True)
+            return entries.get(name)
+
+    def add(self, table, name, record):
+        """Add a record (e.g. one we just created) to an existing table."""
+        with self._lock:
+            if table in self._tables:
+                self._tables[table][1][name] = record
+                self._dirty = True
+
+    def _table(self, table, fetch, refresh=False):
+        loaded, entries = self._tables.get(table, (0, None))
+        if refresh or entries is None or time.time() - loaded >= self.ttl:
+            logger.debug('Listing directory table: %s', table)
+            with metrics.timer('directory.' + table.split(':')[0]):
+                entries = dict(fetch())
+            self._tables[table] = (time.time(), entries)
+            self._dirty = True
+        return entries
+
+    def _load_snapshot(self):
+        if self._snapshot_loaded or not self.snapshot_key:
+            return
+        self._snapshot_loaded = True
+        try:
+            data = read_object(self.snapshot_key)
+            self._tables = {table: (loaded, entries) for table, (loaded, entries) in data.items()
+                            if time.time() - loaded < self.ttl}
+            logger.debug('Loaded directory snapshot with %d tables.', len(self._tables))
+        except Exception as e:
+            logger.info('Unable to load directory snapshot: %s', e)
+
+    def save(self):
+        """Save a snapshot of the directory, if anything has changed."""
+        if not self._dirty or not self.snapshot_key:
+            return
+        try:
+            write_object(self.snapshot_key, self._tables)
+            self._dirty = False
+        except Exception as e:
+            logger.info('Unable to save directory snapshot: %s', e)
+
+
+# Use a global to keep it cached across records and invocations
+directory = Directory(DIRECTORY_TTL, DIRECTORY_SNAPSHOT)
+
+
+class TaskCache:
+    """What we last saw of the task for each issue, keyed by `issue_to_id`.
+
+    Each entry has the task's gid, whether it is assigned and completed, and
+    when it was last modified. Entries are written through from the tasks
+    that come back from finding, creating and updating them, so an update can
+    be worked out without fetching the task first. Someone could change the
+    task in Asana in the meantime, so entries are only trusted for ``ttl``
+    seconds. Within that, a task completed or reopened by hand can be set
+    back by the next event for its issue, as the issue's state wins anyway;
+    assigning is left alone, as `AsanaSync.sync_issue` looks at the task
+    itself before assigning it.
+    """
+
+    def __init__(self, ttl, max_entries=5000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, issue_id):
+        """Get the cached task (gid, assignee, completed, modified_at) for an issue."""
+        with self._lock:
+            stored, task = self._entries.get(issue_id, (0, None))
+            if time.monotonic() - stored >= self.ttl:
+                return None
+            return dict(task)
+
+    def put(self, issue_id, task):
+        """Remember a task that came back from Asana."""
+        entry = dict(gid=task['gid'], assignee=bool(task.get('assignee')),
+                     completed=bool(task.get('completed')), modified_at=task.get('modified_at'))
+        with self._lock:
+            _, current = self._entries.get(issue_id, (0, None))
+            # Responses can come back out of order; keep the most recent
+            if (current and current['gid'] == entry['gid'] and current['modified_at']
+                    and (entry['modified_at'] or '') < current['modified_at']):
+                return
+            self._entries.pop(issue_id, None)
+            self._entries[issue_id] = (time.monotonic(), entry)
+            if len(self._entries) > self.max_entries:
+                del self._entries[next(iter(self._entries))]
+
+    def forget(self, issue_id):
+        with self._lock:
+            self._entries.pop(issue_id, None)
+
+
+# Use a global to keep it cached across records and invocations
+task_cache = TaskCache(TASK_CACHE_TTL)
+
 
 class AsanaSync:
-    def __init__(self, client):
+    def __init__(self, client, batch=None):
         self._client = client
+        self._batch = AsanaBatch(client) if batch is None else batch
 
-    @lru_cache()
+    @metrics.timed('find_workspace')
     def find_workspace(self, org: str):
         """Find the Asana workspace to go with a GitHub organization."""
         org = org.lower()
-        for workspace in self._client.workspaces.find_all():
-            if workspace['name'].lower() == org:
-                return workspace
-        else:
+        workspace = directory.lookup(
+            'workspaces', org,
+            lambda: ((w['name'].lower(), w) for w in self._client.workspaces.find_all()))
+        if workspace is None:
             raise ValueError('Could not find workspace for: {}'.format(org))
+        return workspace
 
-    @lru_cache()
+    @metrics.timed('find_project')
     def find_project(self, workspace: int, repo: str):
         """Find the project to go with the repository."""
         repo = repo.lower()
-        for project in self._client.projects.find_all({'workspace': workspace}):
-            if project['name'].lower().replace(' ', '-') == repo:
-                return project
-        raise ValueError('Could not find appropriate project for: {}'.format(repo))
+        project = directory.lookup(
+            'projects:{}'.format(workspace), repo,
+            lambda: ((p['name'].lower().replace(' ', '-'), p)
+                     for p in self._client.projects.find_all({'workspace': workspace})))
+        if project is None:
+            raise ValueError('Could not find appropriate project for: {}'.format(repo))
+        return project
 
-    @lru_cache()
+    @metrics.timed('find_github_tag')
     def find_github_tag(self, workspace: int):
         """Find the GitHub tag on Asana."""
         tag_name = 'GitHub'
-        for tag in self._client.tags.find_by_workspace(workspace):
-            if tag['name'].lower() == tag_name.lower():
-                break
-        else:  # Did not find one
+        table = 'tags:{}'.format(workspace)
+        tag = directory.lookup(
+            table, tag_name.lower(),
+            lambda: ((t['name'].lower(), t) for t in self._client.tags.find_by_workspace(workspace)))
+        if tag is None:  # Did not find one
             tag = self._client.tags.create_in_workspace(workspace, dict(name=tag_name))
+            directory.add(table, tag_name.lower(), {'gid': tag['gid'], 'name': tag['name']})
 
         return tag['gid']
 
-    @lru_cache()
+    @metrics.timed('github_to_asana_user')
     def github_to_asana_user(self, workspace: int, github_user: str):
         """Figure out the Asana user that corresponds to a GitHub user."""
-        for user in self._client.users.find_by_workspace(workspace):
-            if user['name'] == github_user:
-                return user
-        return 'null'
+        user = directory.lookup(
+            'users:{}'.format(workspace), github_user,
+            lambda: ((u['name'], u) for u in self._client.users.find_by_workspace(workspace)))
+        return 'null' if user is None else user
 
-    @lru_cache()
+    @metrics.timed('find_done_section')
     def find_done_section(self, project: int):
         """Find the done section of a project if there is one."""
-        for section in self._client.sections.find_by_project(project):
-            if section['name'].lower() == 'done':
-                return section['gid']
-        return None
+        section = directory.lookup(
+            'sections:{}'.format(project), 'done',
+            lambda: ((s['name'].lower(), s) for s in self._client.sections.find_by_project(project)))
+        return None if section is None else section['gid']
 
-    def sync_issue(self, issue: IssueInfo):
+    @metrics.timed('sync_issue')
+    def sync_issue(self, issue: IssueInfo, create_new=None):
         """Synchronize a GitHub issue to an Asana task.
 
-        Either create a new task or update attributes of existing task.
+        Either create a new task or update attributes of existing task. By default,
+        whether to create a task is decided by `should_make_new_task`.
         """
         repo = issue.repository
         org = issue.organization
@@ -172,18 +815,12 @@ class AsanaSync:
         workspace = self.find_workspace(org)['gid']
         project = self.find_project(workspace, repo)['gid']
 
-        sync_attrs = {}
-        if issue.assignee:
-            sync_attrs['assignee'] = self.github_to_asana_user(workspace, issue.assignee)
-        else:
-            sync_attrs['assignee'] = 'null'
-
-        sync_attrs['completed'] = issue.state == 'closed'
-
+        sync_attrs = self.issue_attrs(workspace, issue)
         logger.debug('Syncing attributes: %s', str(sync_attrs))
 
         # Create a new task if appropriate
-        create_new = should_make_new_task(issue)
+        if create_new is None:
+            create_new = should_make_new_task(issue)
         logger.debug('Should we create a new task: %s', create_new)
         try:
             if create_new:
@@ -194,23 +831,40 @@ class AsanaSync:
         except asana.error.InvalidRequestError as e:  # Already exists
             logger.exception('Invalid request creating task (likely dupe): %s', e)
 
-        # Ok, it already exists or it's not worthy of a new issue. Try syncing...
+        # Ok, it already exists or it's not worthy of a new issue. Try syncing,
+        # going by what we last saw of the task if we can.
         try:
-            task = self.find_task(issue)
-            logger.info('Found task: %s', task)
-
-            # Check to see if this task was already assigned. If so, don't
-            # re-assign.
-            if task['assignee']:
-                sync_attrs.pop('assignee', None)
+            task = task_cache.get(issue_to_id(issue))
+            cached = task is not None
+            if not cached:
+                task = self.find_task(issue)
+                logger.info('Found task: %s', task)
+            else:
+                logger.debug('Using cached task: %s', task)
 
-            # If the task was already completed, only set it back to not completed
-            # if the event indicates it's back to being worked on.
-            if task['completed'] and not sync_attrs['completed']:
-                sync_attrs['completed'] = issue.action not in ('opened', 'assigned',
-                                                               'reopened', 'ready_for_review')
+            changes = task_updates(task, issue, sync_attrs)
+            if cached and 'assignee' in changes:
+                # Assigning is only done to a task with nobody on it; someone may have
+                # assigned it by hand since we saw it, so look before taking it from them
+                fresh = self.find_task(issue)
+                if fresh['modified_at'] != task['modified_at']:
+                    logger.info('Task %s changed since it was cached.', fresh['gid'])
+                task = fresh
+                changes = task_updates(task, issue, sync_attrs)
+            if not changes:
+                logger.debug('Task is already up to date.')
+                return
 
-            task = self._client.tasks.update(task['gid'], sync_attrs)
+            try:
+                self.update_task(issue, task['gid'], changes)
+            except asana.error.NotFoundError:
+                # The task we remembered is gone (deleted, or merged into another)
+                logger.info('Cached task %s is gone, looking again.', task['gid'])
+                task_cache.forget(issue_to_id(issue))
+                task = self.find_task(issue)
+                changes = task_updates(task, issue, sync_attrs)
+                if changes:
+                    self.update_task(issue, task['gid'], changes)
             logger.debug('Updated task.')
 
             return
@@ -222,12 +876,75 @@ class AsanaSync:
 
         logger.debug('No task created.')
 
+    def issue_attrs(self, workspace: int, issue: IssueInfo):
+        """Get the attributes a task should have to match an issue."""
+        sync_attrs = {}
+        if issue.assignee:
+            sync_attrs['assignee'] = self.github_to_asana_user(workspace, issue.assignee)
+        else:
+            sync_attrs['assignee'] = 'null'
+
+        sync_attrs['completed'] = issue.state == 'closed'
+        return sync_attrs
+
+    @metrics.timed('reconcile')
+    def reconcile(self, org: str, repo: str, issues):
+        """Bring the tasks in a repository's project in line with all of its issues.
+
+        The project's tasks are listed once, rather than looking up each issue's
+        task, and only the tasks that need to change are created or updated, by
+        the same rules as `sync_issue`. Returns the number of tasks created and
+        updated, and how many of those failed.
+        """
+        workspace = self.find_workspace(org)['gid']
+        project = self.find_project(workspace, repo)['gid']
+        tasks = {task['external']['gid']: task
+                 for task in self._client.tasks.find_by_project(
+                     project, {}, fields=['external', 'assignee', 'completed'], page_size=100)
+                 if task.get('external')}
+        logger.info('Reconciling %s/%s against %d tasks.', org, repo, len(tasks))
+
+        creates = []
+        updates = []
+        for issue in issues:
+            task = tasks.get(issue_to_id(issue))
+            if task is None:
+                if should_make_new_task(issue):
+                    creates.append(issue)
+                continue
+
+            changes = task_updates(task, issue, self.issue_attrs(workspace, issue))
+            if changes:
+                updates.append((issue, task['gid'], changes))
+        logger.info('Creating %d tasks and updating %d.', len(creates), len(updates))
+
+        # Send them all at once, so that they share batches
+        with ThreadPoolExecutor(max_workers=AsanaBatch.max_actions) as executor:
+            futures = ([executor.submit(self.sync_issue, issue, create_new=True)
+                        for issue in creates]
+                       + [executor.submit(self.update_task, issue, gid, changes)
+                          for issue, gid, changes in updates])
+        failed = 0
+        for future in futures:
+            if future.exception() is not None:
+                logger.error('Error reconciling %s/%s: %s', org, repo, future.exception())
+                failed += 1
+        return len(creates), len(updates), failed
+
     def find_task(self, issue):
         """Find task corresponding to the issue."""
         try:
-            return self._client.tasks.find_by_id('external:' + issue_to_id(issue))
+            task = self._batch.find_task('external:' + issue_to_id(issue))
         except asana.error.NotFoundError as e:
             raise ValueError('No task found for issue.') from e
+        task_cache.put(issue_to_id(issue), task)
+        return task
+
+    def update_task(self, issue, task: str, changes: dict):
+        """Update the task for an issue."""
+        task = self._batch.update_task(task, changes)
+        task_cache.put(issue_to_id(issue), task)
+        return task
 
     def create_task(self, workspace: int, project: int, issue, attrs: dict):
         """Create a task corresponding to a GitHub issue."""
@@ -238,7 +955,66 @@ class AsanaSync:
                   'projects': [project],
                   'tags': [github_tag]}
         params.update(attrs)
-        return self._client.tasks.create_in_workspace(workspace, params)
+        task = self._batch.create_task(workspace, params)
+        task_cache.put(issue_to_id(issue), task)
+        return task
+
+
+# Event actions that indicate an issue is being worked on (again)
+REOPEN_ACTIONS = ('opened', 'assigned', 'reopened', 'ready_for_review')
+
+
+def task_updates(task, issue, sync_attrs):
+    """Decide which of the attributes for an issue need changing on its existing task.
+
+    Returns only what differs from the task, so nothing to change is an empty dict.
+    """
+    changes = {}
+
+    # Check to see if this task was already assigned. If so, don't re-assign.
+    if not task['assignee'] and sync_attrs['assignee'] != 'null':
+        changes['assignee'] = sync_attrs['assignee']
+
+    # If the task was already completed, only set it back to not completed
+    # if the event indicates it's back to being worked on.
+    completed = sync_attrs['completed']
+    if task['completed'] and not completed:
+        completed = issue.action not in REOPEN_ACTIONS
+    if completed != task['completed']:
+        changes['completed'] = completed
+    return changes
+
+
+def coalesce_issues(issues):
+    """Collapse several events (in order) for one issue into one to sync.
+
+    Returns the issue to sync and whether a new task is warranted. The result
+    matches syncing each event in turn: a task is created if any event calls
+    for one, the first assignee sticks, and a completed task is reopened if any
+    event indicates the issue is being worked on again.
+    """
+    final = issues[-1]
+    create_new = any(should_make_new_task(issue) for issue in issues)
+    assignee = next((issue.assignee for issue in issues if issue.assignee), None)
+    action = next((issue.action for issue in issues if issue.action in REOPEN_ACTIONS),
+                  final.action)
+    return final._replace(assignee=assignee, action=action), create_new
+
+
+def desired_state(issue, create_new):
+    """Make a short hash of everything that syncing an issue's event depends on.
+
+    The issue's update time is part of it, so that only a repeat of the same
+    event can match: another container may have synced later events for the
+    issue (closing it, say) since this one last saw it, and reopening must not
+    look like the opening it saw. Without that time, there's no telling, so
+    None is returned and the event is always synced.
+    """
+    if not issue.updated_at:
+        return None
+    state = [create_new, issue.title, issue.state, issue.assignee, issue.html_url, issue.body,
+             issue.action in REOPEN_ACTIONS, issue.updated_at]
+    return hashlib.sha256(json.dumps(state).encode('utf-8')).hexdigest()[:16]
 
 
 def should_make_new_task(issue):
@@ -268,3 +1044,10 @@ def should_make_new_task(issue):
 def issue_to_id(issue):
     """Create a unique id from an issue."""
     return '{0.organization}-{0.repository}-{0.number:d}'.format(issue)
+
+
+def payload_to_id(json: dict):
+    """Create the same unique id as `issue_to_id` straight from event json."""
+    nested = json['pull_request'] if 'pull_request' in json else json['issue']
+    return '{}-{}-{:d}'.format(json['organization']['login'], json['repository']['name'],
+                               nested['number'])